@@ -1,47 +1,94 @@
-from supabase import Client, create_client
+from supabase import AClient, acreate_client
 from dotenv import load_dotenv
 import os
 import asyncio
+from app.pokolorach.instrumentation import stage
 
 load_dotenv()
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_SECRET_KEY = os.getenv("SUPABASE_SECRET_KEY")
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_SECRET_KEY)
+# One async client per process. Its storage and PostgREST sub-clients each
+# keep a single pooled httpx.AsyncClient, so connections are reused across
+# requests.
+supabase: AClient = None
+supabase_lock = asyncio.Lock()
 
-def save_image(storage_path: str, file_contents, filename: str, file_options: dict):
+
+async def get_supabase():
+    global supabase
+    if supabase is None:
+        async with supabase_lock:
+            if supabase is None:
+                supabase = await acreate_client(SUPABASE_URL, SUPABASE_SECRET_KEY)
+    return supabase
+
+
+async def save_image(storage_path: str, file_contents, filename: str, file_options: dict):
+    client = await get_supabase()
     path_on_supastorage = f"{storage_path}/{filename}"
-    response = supabase.storage.from_(storage_path).upload(
-        path=path_on_supastorage,
-        file=file_contents,
-        file_options=file_options
-    )
-    image_url = supabase.storage.from_(storage_path).create_signed_url(
-        path_on_supastorage,
-        expires_in=60)["signedURL"]
-    
-    return response, image_url
+    with stage("storage_upload"):
+        response = await client.storage.from_(storage_path).upload(
+            path=path_on_supastorage,
+            file=file_contents,
+            file_options=file_options
+        )
+        signed_url = await client.storage.from_(storage_path).create_signed_url(
+            path_on_supastorage,
+            expires_in=60)
+
+    return response, signed_url["signedURL"]
 
 
-def save_entry(table_name: str, data: dict):
-    response = supabase.table(table_name).insert(data).execute()
+async def save_entry(table_name: str, data: dict):
+    client = await get_supabase()
+    with stage("entry_insert"):
+        response = await client.table(table_name).insert(data).execute()
     entry_id = response.data[0]["id"]
     return response, entry_id
 
 
-def update_image_entry(table_name: str, image_url: str, entry_id: int, column: str):
-    response = supabase.table(table_name).update({f"{column}": image_url}).eq("id", entry_id).execute()
+async def update_entry(table_name: str, entry_id: int, data: dict):
+    client = await get_supabase()
+    with stage("entry_update"):
+        response = await client.table(table_name).update(data).eq("id", entry_id).execute()
     return response
 
 
 async def remove_image(storage_path: str, file_name: str, delay: int = 300):
     await asyncio.sleep(delay)
-    response = supabase.storage.from_(storage_path).remove([f"{storage_path}/{file_name}"])
+    client = await get_supabase()
+    response = await client.storage.from_(storage_path).remove([f"{storage_path}/{file_name}"])
     return response
 
-def get_entry(table_name: str, entry_id: int, column: str):
-    response = supabase.table(table_name).select(column).eq("id", entry_id).execute()
-    return response.data[0][column]
+
+async def upload_result_image(storage_path: str, filename: str, image_bytes, content_type: str = "image/png"):
+    _, signed_url = await save_image(storage_path=storage_path, file_contents=image_bytes, filename=filename,
+                                     file_options={"content-type": content_type})
+    return signed_url
+
+
+async def upload_result_images(filename: str, cluster_image_bytes, outline_image_bytes, content_type: str = "image/png",
+                               outline_content_type: str = None, img_cluster_url: str = None):
+    # A cluster image that was already uploaded ahead of its outline is not uploaded again
+    if img_cluster_url is not None:
+        img_outline_url = await upload_result_image("outline_image", filename, outline_image_bytes,
+                                                    outline_content_type or content_type)
+        return img_cluster_url, img_outline_url
+
+    return await asyncio.gather(
+        upload_result_image("cluster_image", filename, cluster_image_bytes, content_type),
+        upload_result_image("outline_image", filename, outline_image_bytes, outline_content_type or content_type)
+    )
 
 
+async def save_result_images(entry_id: int, filename: str, cluster_image_bytes, outline_image_bytes, content_type: str = "image/png",
+                             outline_content_type: str = None, img_cluster_url: str = None):
+    img_cluster_url, img_outline_url = await upload_result_images(filename, cluster_image_bytes, outline_image_bytes, content_type,
+                                                                  outline_content_type, img_cluster_url)
+    await update_entry(table_name="Entries", entry_id=entry_id, data={
+        "img_cluster_url": img_cluster_url,
+        "img_outline_url": img_outline_url
+    })
+    return img_cluster_url, img_outline_url
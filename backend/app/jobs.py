@@ -0,0 +1,313 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import Manager
+import asyncio
+import json
+import logging
+import os
+import traceback
+import uuid
+import numpy as np
+from app.database import remove_image, save_result_images, upload_result_image, upload_result_images
+from app.pokolorach.process_image import process_image
+from app.pokolorach.blob_cache import blob_cache
+from app.pokolorach.encoding import CONTENT_TYPES, IMAGE_FORMAT
+from app.pokolorach.instrumentation import TRACE_MEMORY, Trace, current_trace
+from app import metrics
+from app.pokolorach.result_cache import result_cache
+from app.pokolorach.tiles import init_process_worker
+
+PROCESS_WORKERS = int(os.getenv("PROCESS_WORKERS", os.cpu_count() or 1))
+JOB_TTL = int(os.getenv("JOB_TTL", 3600))
+PROGRESS_POLL_INTERVAL = float(os.getenv("PROGRESS_POLL_INTERVAL", 0.2))
+EVENTS_KEEPALIVE = float(os.getenv("EVENTS_KEEPALIVE", 15))
+CACHE_STATS_KEY = "result_cache:stats"
+
+# Progress events named after the pipeline stage whose end they mark
+STAGE_EVENTS = {
+    "decode": "decoded",
+    "preprocess": "denoised",
+    "cluster": "clustered",
+    "facets": "facets_cleaned",
+    "label_locs": "labels_placed",
+}
+FINAL_EVENTS = ("uploaded", "failed")
+
+executor = ProcessPoolExecutor(max_workers=PROCESS_WORKERS, initializer=init_process_worker,
+                               initargs=(PROCESS_WORKERS,))
+background_tasks = set()
+# Serves the queues that carry progress from the worker processes; started on first use
+progress_manager = None
+
+
+def get_progress_manager():
+    global progress_manager
+    if progress_manager is None:
+        progress_manager = Manager()
+    return progress_manager
+
+
+def serialize_numpy(obj):
+    if isinstance(obj, np.integer):
+        return int(obj)
+    elif isinstance(obj, np.floating):
+        return float(obj)
+    elif isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return obj
+
+
+def serialize_mapping(label_color_mapping):
+    return {str(k): [serialize_numpy(i) for i in v] for k, v in label_color_mapping.items()}
+
+
+def run_process_image(params, trace_memory=TRACE_MEMORY, progress=None):
+    # Runs inside a worker process, so the result must be plain picklable data.
+    # Progress events and each cluster image, as soon as it is encoded, are put
+    # on the progress queue for the API process.
+    on_stage = on_cluster = None
+    if progress is not None:
+        sent_events = set()
+
+        def on_stage(record):
+            event = STAGE_EVENTS.get(record["stage"])
+            if event is None:
+                return
+            # A preprocess stage served from the stage cache does not decode
+            if event == "denoised" and "decoded" not in sent_events:
+                progress.put(("decoded", {}))
+                sent_events.add("decoded")
+            progress.put((event, {}))
+            sent_events.add(event)
+
+        def on_cluster(n_clusters, cluster_image_bytes):
+            progress.put(("cluster_image", {"n_clusters": n_clusters, "image_bytes": cluster_image_bytes}))
+
+    misses_before = result_cache.misses
+    with Trace(memory=trace_memory, on_stage=on_stage) as trace:
+        try:
+            result = process_image(**params, on_cluster=on_cluster)
+        except Exception as e:
+            # Pickled along with the exception, so the API process can observe
+            # the stages that ran before the failure
+            e.records = trace.records
+            raise
+    variants = result if params.get("n_clusters_list") else [result]
+    return [(cluster_image_bytes, outline_image_bytes, serialize_mapping(label_color_mapping))
+            for cluster_image_bytes, outline_image_bytes, label_color_mapping in variants], result_cache.misses == misses_before, trace.records
+
+
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def push_event(redis, job_id, event, data=None):
+    events_key = f"job:{job_id}:events"
+    async with redis.pipeline(transaction=True) as pipe:
+        await pipe.rpush(events_key, json.dumps({"event": event, **(data or {})})).expire(events_key, JOB_TTL).execute()
+
+
+def remove_results(stored_filenames):
+    # Also covers images a failed job uploaded before it failed
+    for stored_filename in stored_filenames:
+        spawn(remove_image("cluster_image", stored_filename))
+        spawn(remove_image("outline_image", stored_filename))
+
+
+async def relay_progress(redis, job_id, progress, upload_cluster):
+    """
+    Move a job's progress events from the worker's queue to Redis until the
+    None that ends the job, and start uploading each cluster image as it
+    arrives. Returns the upload tasks by cluster count.
+    """
+    # Each get is a round trip to the manager process, so it waits on a thread
+    # rather than on the event loop
+    loop = asyncio.get_running_loop()
+    cluster_uploads = {}
+    while True:
+        message = await loop.run_in_executor(None, progress.get)
+        if message is None:
+            return cluster_uploads
+
+        event, data = message
+        if event == "cluster_image":
+            cluster_uploads[data["n_clusters"]] = spawn(upload_cluster(data["n_clusters"], data["image_bytes"]))
+        else:
+            await push_event(redis, job_id, event, data)
+
+
+async def submit_job(redis, upload_id, upload_state, params):
+    job_id = str(uuid.uuid4())
+    job_key = f"job:{job_id}"
+    async with redis.pipeline(transaction=True) as pipe:
+        await pipe.hset(job_key, mapping={"status": "queued"}).expire(job_key, JOB_TTL).execute()
+    spawn(run_job(redis, job_id, upload_id, upload_state, params))
+    return job_id
+
+
+async def run_job(redis, job_id, upload_id, upload_state, params):
+    job_key = f"job:{job_id}"
+    filename = upload_state["filename"]
+    loop = asyncio.get_running_loop()
+    include_trace = params.get("trace", False)
+    params = {k: v for k, v in params.items() if k != "trace"}
+    # Results are stored under the job's own names, so running another job for
+    # the same upload neither collides with this one's files nor has them
+    # removed by this one's cleanup. Sweep variants are not written to the
+    # Entries row, which holds the variant the user settles on.
+    n_clusters_list = params.get("n_clusters_list")
+    result_filename = f"{job_id}_{filename}"
+    variant_filenames = {n: f"{job_id}_{n}_{filename}" for n in n_clusters_list or []}
+    stored_filenames = list(variant_filenames.values()) if n_clusters_list else [result_filename]
+    content_type = CONTENT_TYPES[params.get("image_format", IMAGE_FORMAT)]
+    # SVG outlines are small, so they are also returned inline for the
+    # client to render without fetching them.
+    svg_outline = params.get("outline_format") == "svg"
+    outline_content_type = CONTENT_TYPES["svg"] if svg_outline else content_type
+
+    async def upload_cluster(n_clusters, cluster_image_bytes):
+        img_cluster_url = await upload_result_image("cluster_image", variant_filenames.get(n_clusters, result_filename),
+                                                    cluster_image_bytes, content_type)
+        await push_event(redis, job_id, "cluster_ready", {"n_clusters": n_clusters, "img_cluster_url": img_cluster_url})
+        return img_cluster_url
+
+    # Each job runs in its own task, so the trace set here only sees this
+    # job's storage calls. They are timed without tracemalloc, which cannot
+    # tell concurrent jobs apart.
+    storage_trace = Trace(memory=False)
+    current_trace.set(storage_trace)
+    records = []
+    try:
+        # The upload's bytes are handed to the worker directly when this process
+        # still holds them; otherwise the worker checks the spilled blobs and
+        # only then fetches image_url.
+        source = {
+            "image_bytes": blob_cache.get(upload_id),
+            "upload_id": upload_id,
+            "image_url": upload_state["image_url"]
+        }
+        # CPU work runs in the process pool; the uploads run here on the event
+        # loop, sharing the pooled storage client. Cluster images are uploaded
+        # while the worker is still drawing their outlines.
+        progress = get_progress_manager().Queue()
+        relay = spawn(relay_progress(redis, job_id, progress, upload_cluster))
+        try:
+            variants, cache_hit, records = await loop.run_in_executor(
+                executor, run_process_image, {**source, **params}, include_trace or TRACE_MEMORY, progress)
+        finally:
+            progress.put(None)
+            cluster_uploads = await relay
+
+        img_cluster_urls = {n: await upload for n, upload in cluster_uploads.items()}
+        if n_clusters_list:
+            urls = await asyncio.gather(*(
+                upload_result_images(variant_filenames[n], cluster_image_bytes, outline_image_bytes, content_type, outline_content_type,
+                                     img_cluster_urls.get(n))
+                for n, (cluster_image_bytes, outline_image_bytes, _) in zip(n_clusters_list, variants)))
+            result = {"cache_hit": cache_hit, "variants": [
+                {"n_clusters": n, "img_cluster_url": img_cluster_url, "img_outline_url": img_outline_url,
+                 "label_color_mapping": label_color_mapping}
+                for n, (img_cluster_url, img_outline_url), (_, _, label_color_mapping)
+                in zip(n_clusters_list, urls, variants)]}
+            if svg_outline:
+                for variant, (_, outline_image_bytes, _) in zip(result["variants"], variants):
+                    variant["outline_svg"] = outline_image_bytes.decode()
+        else:
+            cluster_image_bytes, outline_image_bytes, label_color_mapping = variants[0]
+            img_cluster_url, img_outline_url = await save_result_images(
+                entry_id=upload_state["entry_id"], filename=result_filename,
+                cluster_image_bytes=cluster_image_bytes, outline_image_bytes=outline_image_bytes,
+                content_type=content_type, outline_content_type=outline_content_type,
+                img_cluster_url=next(iter(img_cluster_urls.values()), None))
+            result = {"label_color_mapping": label_color_mapping, "cache_hit": cache_hit,
+                      "img_cluster_url": img_cluster_url, "img_outline_url": img_outline_url}
+            if svg_outline:
+                result["outline_svg"] = outline_image_bytes.decode()
+        metrics.observe(records + storage_trace.records)
+        if include_trace:
+            result["trace"] = records + storage_trace.records
+    except Exception as e:
+        # Failed jobs are observed too, so the histograms are not skewed
+        # towards the runs that succeeded
+        metrics.observe((records or getattr(e, "records", [])) + storage_trace.records)
+        logging.error(f"Error in job {job_id}: {str(e)}")
+        logging.error(traceback.format_exc())
+        await redis.hset(job_key, mapping={"status": "failed", "error": str(e)})
+        await push_event(redis, job_id, "failed", {"error": str(e)})
+        remove_results(stored_filenames)
+        return
+
+    # The final event carries the same result as a completed job
+    events_key = f"job:{job_id}:events"
+    async with redis.pipeline(transaction=True) as pipe:
+        await (pipe.hset(job_key, mapping={"status": "complete", "result": json.dumps(result)})
+               .hincrby(CACHE_STATS_KEY, "hits" if result["cache_hit"] else "misses", 1)
+               .rpush(events_key, json.dumps({"event": "uploaded", "status": "complete", "job_id": job_id, **result}))
+               .expire(events_key, JOB_TTL)
+               .execute())
+
+    remove_results(stored_filenames)
+
+
+
+async def get_job(redis, job_id):
+    job = await redis.hgetall(f"job:{job_id}")
+    if not job:
+        return None
+
+    response_data = {"status": job["status"], "job_id": job_id}
+    if job["status"] == "complete":
+        response_data.update(json.loads(job["result"]))
+    elif job["status"] == "failed":
+        response_data["error"] = job["error"]
+    return response_data
+
+
+async def job_events(redis, job_id, start=0):
+    """
+    Yield a job's progress events as (index, event) pairs, starting at index
+    start and ending with its final event. Waits for events that have not
+    happened yet, and yields None after EVENTS_KEEPALIVE seconds without any
+    so the caller can keep its connection alive.
+    """
+    events_key = f"job:{job_id}:events"
+    index = start
+    idle = 0
+    while True:
+        events = await redis.lrange(events_key, index, -1)
+        for event in events:
+            event = json.loads(event)
+            yield index, event
+            index += 1
+            if event["event"] in FINAL_EVENTS:
+                return
+
+        if events:
+            idle = 0
+            continue
+        # The job expired without a final event reaching this reader
+        if not await redis.exists(f"job:{job_id}"):
+            return
+        await asyncio.sleep(PROGRESS_POLL_INTERVAL)
+        idle += PROGRESS_POLL_INTERVAL
+        if idle >= EVENTS_KEEPALIVE:
+            idle = 0
+            yield None
+
+
+async def get_cache_stats(redis):
+    # Hit and miss counters are aggregated across worker processes in Redis;
+    # the disk usage is read from the shared cache directory.
+    counters = await redis.hgetall(CACHE_STATS_KEY)
+    stats = result_cache.stats()
+    stats["hits"] = int(counters.get("hits", 0))
+    stats["misses"] = int(counters.get("misses", 0))
+    return stats
+
+
+def shutdown():
+    executor.shutdown(wait=False, cancel_futures=True)
+    if progress_manager is not None:
+        progress_manager.shutdown()
@@ -1,8 +1,8 @@
-from fastapi import FastAPI, Request, UploadFile, File, HTTPException, status, Query
+from fastapi import FastAPI, Request, UploadFile, File, HTTPException, status, Query, Header
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import  JSONResponse
+from fastapi.responses import  JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List
+from typing import List, Optional
 from PIL import Image
 import numpy as np
 import io
@@ -13,10 +13,67 @@ import uuid
 import logging
 import traceback
 from aioredis import Redis, from_url
-from app.database import supabase, save_image, save_entry, remove_image
-from app.pokolorach.process_image import process_image
+from app.database import save_image, save_entry
+from app.sessions import save_upload_state, get_upload_state
+from app.pokolorach.blob_cache import blob_cache
+from app.jobs import submit_job, get_job, job_events, get_cache_stats, shutdown as shutdown_jobs
+from app import metrics
+from app.pokolorach.instrumentation import Trace
+
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 25 * 1024 * 1024))
+# Room for the multipart framing around the file
+MAX_UPLOAD_BODY_BYTES = MAX_UPLOAD_BYTES + 64 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Working resolution for /process jobs; large JPEGs are decoded straight to it.
+PROCESS_MAX_WORKING_EDGE = int(os.getenv("PROCESS_MAX_WORKING_EDGE", 0)) or None
+# Each sweep variant is a k-means run on one worker
+MAX_SWEEP_VARIANTS = int(os.getenv("MAX_SWEEP_VARIANTS", 8))
+
+
+class BodyLimitMiddleware:
+    """
+    Reject request bodies on the given paths that are larger than max_bytes.
+
+    FastAPI receives and spools a whole multipart body before the endpoint
+    runs, so the limit is enforced here instead: on the Content-Length header
+    before anything is read, and on the bytes received so far for bodies sent
+    without one.
+    """
+    def __init__(self, app, paths, max_bytes):
+        self.app = app
+        self.paths = set(paths)
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        too_large = HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                  detail=f"Request body exceeds the {self.max_bytes} byte limit")
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = JSONResponse({"detail": too_large.detail}, status_code=too_large.status_code,
+                                    headers={"Connection": "close"})
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise too_large
+            return message
+
+        await self.app(scope, limited_receive, send)
+
 
 app = FastAPI()
+app.add_middleware(BodyLimitMiddleware, paths=["/upload"], max_bytes=MAX_UPLOAD_BODY_BYTES)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000", "http://192.168.56.1:3000"],
@@ -27,125 +84,205 @@ app.add_middleware(
 
 redis = from_url("redis://localhost", encoding="utf-8", decode_responses=True)
 
+
+async def read_upload(file: UploadFile, max_bytes: int):
+    # Read in chunks so an oversized upload is rejected as soon as it crosses
+    # the limit, without first being read into memory in full.
+    chunks = []
+    size = 0
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        size += len(chunk)
+        if size > max_bytes:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                detail=f"File exceeds the {max_bytes} byte upload limit")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
 @app.get("/")
 async def main():
-    img_url = await redis.get("image_url")
-    return {"img_url": img_url}
+    return {"status": "ok"}
 
 @app.post("/upload")
 async def upload(file: UploadFile = File(...)):
+    # Storage and database calls are timed without tracemalloc, which cannot
+    # tell concurrent requests apart.
+    trace = Trace(memory=False)
     try:
-        file_contents = await file.read()
-        file_extension = file.filename.rsplit('.', 1)[1].lower()
-        unique_filename = f"{uuid.uuid4()}.{file_extension}"
-
-        response, image_url = save_image(
-            storage_path="input_image", 
-            file_contents=file_contents, 
-            filename=unique_filename,
-            file_options={"content-type": file.content_type}
-        )
-
-        new_image_data = {
-            "img_name": unique_filename,
-            "img_url": image_url,
-            "img_cluster_url": None,
-            "img_outline_url": None,
-            "img_type": None
-        }
+        with trace:
+            file_contents = await read_upload(file, MAX_UPLOAD_BYTES)
+            file_extension = file.filename.rsplit('.', 1)[1].lower()
+            upload_id = str(uuid.uuid4())
+            unique_filename = f"{upload_id}.{file_extension}"
+            blob_cache.put(upload_id, file_contents)
 
-        response, entry_id = save_entry(table_name="Entries", data=new_image_data)
+            response, image_url = await save_image(
+                storage_path="input_image", 
+                file_contents=file_contents, 
+                filename=unique_filename,
+                file_options={"content-type": file.content_type}
+            )
 
-        await redis.set("image_url", image_url)
-        await redis.set("filename", unique_filename)
-        await redis.set("entry_id", entry_id)
-        await redis.set("content_type", file.content_type)
+            new_image_data = {
+                "img_name": unique_filename,
+                "img_url": image_url,
+                "img_cluster_url": None,
+                "img_outline_url": None,
+                "img_type": None
+            }
 
-        return JSONResponse(content={
-            "status": "complete",
-            "image_url": image_url,
-            "unique_filename": unique_filename
-        })
+            response, entry_id = await save_entry(table_name="Entries", data=new_image_data)
+
+            await save_upload_state(redis, upload_id, {
+                "image_url": image_url,
+                "filename": unique_filename,
+                "entry_id": entry_id,
+                "content_type": file.content_type
+            })
+
+            return JSONResponse(content={
+                "status": "complete",
+                "image_url": image_url,
+                "unique_filename": unique_filename,
+                "upload_id": upload_id
+            })
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
     finally:
+        metrics.observe(trace.records)
         await file.close()
 
-@app.post("/process")
-async def process():
+@app.post("/process", status_code=status.HTTP_202_ACCEPTED)
+async def process(upload_id: str = Query(...), outline_format: str = Query("raster", pattern="^(raster|svg)$"),
+                  trace: bool = Query(False),
+                  min_size: int = Query(300, ge=1, le=10000),
+                  area_threshold_factor: int = Query(200, ge=1, le=10000),
+                  font_scale_small: float = Query(0.2, gt=0, le=5),
+                  font_scale_medium: float = Query(0.3, gt=0, le=5),
+                  font_scale_large: float = Query(0.5, gt=0, le=5)):
     try:
-        image_url = await redis.get("image_url")
-        filename = await redis.get("filename")
-        entry_id = await redis.get("entry_id")
-        content_type = await redis.get("content_type")
-
-        def serialize_numpy(obj):
-            if isinstance(obj, np.integer):
-                return int(obj)
-            elif isinstance(obj, np.floating):
-                return float(obj)
-            elif isinstance(obj, np.ndarray):
-                return obj.tolist()
-            return obj
-
-        if not image_url:
+        upload_state = await get_upload_state(redis, upload_id)
+
+        if not upload_state:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Image not found")
 
-        img_cluster_url, img_outline_url, label_color_mapping = process_image(
-            file_name=filename,
-            entry_id=entry_id,
-            file_options={"content-type": content_type},
-            image_url=image_url,
-            n_clusters=20,
-            blur_radius=1
-        )
+        # The clustering settings are fixed; the facet and label settings can be
+        # tuned per request, and re-running with new ones reuses the cached
+        # decode, denoise and k-means stages.
+        job_id = await submit_job(redis, upload_id, upload_state, {
+            "n_clusters": 20,
+            "blur_radius": 1,
+            "max_working_edge": PROCESS_MAX_WORKING_EDGE,
+            "outline_format": outline_format,
+            "min_size": min_size,
+            "area_threshold_factor": area_threshold_factor,
+            "font_scale_small": font_scale_small,
+            "font_scale_medium": font_scale_medium,
+            "font_scale_large": font_scale_large,
+            "trace": trace
+        })
 
-        asyncio.create_task(remove_image("cluster_image", filename))
-        asyncio.create_task(remove_image("outline_image", filename))
+        return {"status": "queued", "job_id": job_id}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error in /process: {str(e)}")
+        logging.error(traceback.format_exc())
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Unexpected error: {str(e)}")
 
-        serializable_mapping = {str(k): [serialize_numpy(i) for i in v] for k, v in label_color_mapping.items()}
 
+@app.post("/process/sweep", status_code=status.HTTP_202_ACCEPTED)
+async def process_sweep(upload_id: str = Query(...), n_clusters: List[int] = Query(...),
+                        outline_format: str = Query("raster", pattern="^(raster|svg)$"), trace: bool = Query(False)):
+    try:
+        n_clusters_list = sorted(set(n_clusters))
+        if not n_clusters_list or n_clusters_list[0] < 2 or n_clusters_list[-1] > 255:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="n_clusters values must be between 2 and 255")
+        if len(n_clusters_list) > MAX_SWEEP_VARIANTS:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                                detail=f"At most {MAX_SWEEP_VARIANTS} n_clusters values can be swept at once")
 
-        response_data = {
-            "status": "complete",
-            "img_cluster_url": img_cluster_url,
-            "img_outline_url": img_outline_url,
-            "label_color_mapping": serializable_mapping
-        }
+        upload_state = await get_upload_state(redis, upload_id)
 
-        json_data = json.dumps(response_data)
+        if not upload_state:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Image not found")
 
-        return JSONResponse(content=json.loads(json_data))
-    except json.JSONDecodeError as json_error:
-        logging.error(f"JSON serialization error: {str(json_error)}")
-        logging.error(traceback.format_exc())
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"JSON serialization error: {str(json_error)}")
+        job_id = await submit_job(redis, upload_id, upload_state, {
+            "n_clusters_list": n_clusters_list,
+            "blur_radius": 1,
+            "max_working_edge": PROCESS_MAX_WORKING_EDGE,
+            "outline_format": outline_format,
+            "trace": trace
+        })
+
+        return {"status": "queued", "job_id": job_id}
+    except HTTPException:
+        raise
     except Exception as e:
-        logging.error(f"Error in /process: {str(e)}")
+        logging.error(f"Error in /process/sweep: {str(e)}")
         logging.error(traceback.format_exc())
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Unexpected error: {str(e)}")
+
+
+@app.get("/process/{job_id}")
+async def get_process_status(job_id: str):
+    job = await get_job(redis, job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return job
+
+
+@app.get("/process/{job_id}/events")
+async def stream_process_events(job_id: str, last_event_id: Optional[int] = Header(None)):
+    # Server-sent events: decoded, denoised, clustered, facets_cleaned,
+    # cluster_ready (with img_cluster_url, before the outline is done),
+    # labels_placed, and finally uploaded (with the same result as
+    # GET /process/{job_id}) or failed. A job served from the result cache
+    # runs no stages, so it only sends cluster_ready and its final event. A
+    # reconnecting EventSource resumes after the last event it received.
+    if await get_job(redis, job_id) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+
+    async def event_stream():
+        start = last_event_id + 1 if last_event_id is not None else 0
+        async for item in job_events(redis, job_id, start):
+            if item is None:
+                yield ": keep-alive\n\n"
+                continue
+            index, event = item
+            yield f"id: {index}\nevent: {event['event']}\ndata: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return await get_cache_stats(redis)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    shutdown_jobs()
     
 
 @app.get("/painting/{unique_filename}")
 async def get_painting(unique_filename: str):
     try:
-        image_url = await redis.get("image_url")
-        filename = await redis.get("filename")
+        upload_state = await get_upload_state(redis, unique_filename)
 
-        if not image_url or not filename:
+        if not upload_state:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Painting data not found in Redis")
 
-        stored_filename_without_ext = filename.rsplit('.', 1)[0]
-
-        if stored_filename_without_ext != unique_filename:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST, 
-                detail=f"Filename mismatch. Stored: {stored_filename_without_ext}, Requested: {unique_filename}"
-            )
-
         painting_data = {
-            "img_url": image_url,
-            "img_name": filename,
+            "img_url": upload_state["image_url"],
+            "img_name": upload_state["filename"],
         }
         return painting_data
     except HTTPException as he:
@@ -154,5 +291,3 @@ async def get_painting(unique_filename: str):
     except Exception as e:
         print(f"Unexpected error in get_painting: {str(e)}")
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
-
-
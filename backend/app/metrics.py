@@ -0,0 +1,57 @@
+from collections import defaultdict
+import math
+
+class Histogram:
+    """
+    Prometheus-style histogram with one series per stage label.
+    """
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets) + (math.inf,)
+        self.counts = defaultdict(lambda: [0] * len(self.buckets))
+        self.sums = defaultdict(float)
+
+    def observe(self, stage, value):
+        counts = self.counts[stage]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.sums[stage] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for stage in sorted(self.counts):
+            counts = self.counts[stage]
+            for bound, count in zip(self.buckets, counts):
+                le = "+Inf" if bound == math.inf else repr(float(bound))
+                lines.append(f'{self.name}_bucket{{stage="{stage}",le="{le}"}} {count}')
+            lines.append(f'{self.name}_sum{{stage="{stage}"}} {self.sums[stage]}')
+            lines.append(f'{self.name}_count{{stage="{stage}"}} {counts[-1]}')
+        return "\n".join(lines)
+
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+stage_seconds = Histogram("pokolorach_stage_seconds", "Wall time of each processing stage in seconds.", SECONDS_BUCKETS)
+stage_cpu_seconds = Histogram("pokolorach_stage_cpu_seconds", "CPU time of each processing stage in seconds.", SECONDS_BUCKETS)
+stage_peak_bytes = Histogram("pokolorach_stage_peak_bytes", "Peak memory allocated by each processing stage in bytes.",
+                             [2 ** exponent for exponent in range(20, 36, 2)])
+stage_megapixels = Histogram("pokolorach_stage_megapixels", "Image size each processing stage worked on in megapixels.",
+                             (0.25, 0.5, 1, 2, 4, 8, 12, 16, 24, 48))
+
+
+def observe(records):
+    for record in records:
+        stage = record["stage"]
+        stage_seconds.observe(stage, record["wall_seconds"])
+        stage_cpu_seconds.observe(stage, record["cpu_seconds"])
+        if record.get("peak_bytes") is not None:
+            stage_peak_bytes.observe(stage, record["peak_bytes"])
+        if "width" in record:
+            stage_megapixels.observe(stage, record["width"] * record["height"] / 1e6)
+
+
+def render():
+    return "\n".join(histogram.render() for histogram in
+                     (stage_seconds, stage_cpu_seconds, stage_peak_bytes, stage_megapixels)) + "\n"
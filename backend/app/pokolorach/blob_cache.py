@@ -0,0 +1,78 @@
+import os
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from .disk_lru import evict_lru
+
+BLOB_CACHE_DIR = os.getenv("BLOB_CACHE_DIR", os.path.join(tempfile.gettempdir(), "pokolorach_blobs"))
+BLOB_CACHE_MAX_MEMORY_BYTES = int(os.getenv("BLOB_CACHE_MAX_MEMORY_BYTES", 256 * 1024 * 1024))
+BLOB_CACHE_MAX_DISK_BYTES = int(os.getenv("BLOB_CACHE_MAX_DISK_BYTES", 2 * 1024 * 1024 * 1024))
+
+class BlobCache:
+    """
+    Size-bounded cache of uploaded image bytes, keyed by upload id.
+
+    Recent uploads are kept in memory. When the memory budget is exceeded the
+    least recently used blobs are spilled to files in cache_dir, which is
+    itself an LRU bounded by max_disk_bytes. Spilled blobs are visible to
+    every process sharing the directory, including the job workers.
+    """
+    def __init__(self, cache_dir=BLOB_CACHE_DIR, max_memory_bytes=BLOB_CACHE_MAX_MEMORY_BYTES,
+                 max_disk_bytes=BLOB_CACHE_MAX_DISK_BYTES):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.blobs = OrderedDict()
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def put(self, key, data):
+        data = bytes(data)
+        with self.lock:
+            if key in self.blobs:
+                self.memory_bytes -= len(self.blobs.pop(key))
+            self.blobs[key] = data
+            self.memory_bytes += len(data)
+            spilled = []
+            while self.memory_bytes > self.max_memory_bytes and self.blobs:
+                spilled_key, spilled_data = self.blobs.popitem(last=False)
+                self.memory_bytes -= len(spilled_data)
+                spilled.append((spilled_key, spilled_data))
+
+        for spilled_key, spilled_data in spilled:
+            self.spill(spilled_key, spilled_data)
+        if spilled:
+            self.evict()
+
+    def spill(self, key, data):
+        # Write under a private name and rename into place, so that readers in
+        # other processes never see a partial file.
+        tmp_path = os.path.join(self.cache_dir, f".tmp-{uuid.uuid4()}")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path(key))
+
+    def get(self, key):
+        with self.lock:
+            data = self.blobs.get(key)
+            if data is not None:
+                self.blobs.move_to_end(key)
+                return data
+
+        try:
+            with open(self.path(key), "rb") as f:
+                data = f.read()
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            return None
+        return data
+
+    def evict(self):
+        evict_lru(self.cache_dir, self.max_disk_bytes)
+
+blob_cache = BlobCache()
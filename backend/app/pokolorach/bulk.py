@@ -0,0 +1,126 @@
+"""
+Process every image in a directory into local cluster, outline and mapping
+files, for pre-generating a catalogue without touching storage.
+
+For an input image <name>.<ext> the output directory receives
+<name>_cluster.<format>, <name>_outline.<format or svg> and <name>.json (the
+label colour mapping). The JSON file is written last, so an image counts as done once it
+exists; re-running the command skips finished images.
+
+Usage (from the backend directory):
+    python -m app.pokolorach.bulk input_dir output_dir [--workers 4] [--n-clusters 20] [--blur-radius 1]
+
+Each worker process runs its tile threads on cpu_count // workers threads,
+unless TILE_WORKERS is set.
+"""
+import argparse
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .process_image import process_image
+from .tiles import init_process_worker
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff")
+
+
+def output_paths(output_dir, name, image_format="png", outline_format="raster"):
+    outline_extension = "svg" if outline_format == "svg" else image_format
+    return (os.path.join(output_dir, f"{name}_cluster.{image_format}"),
+            os.path.join(output_dir, f"{name}_outline.{outline_extension}"),
+            os.path.join(output_dir, f"{name}.json"))
+
+
+def write_atomic(path, data):
+    tmp_path = os.path.join(os.path.dirname(path), f".tmp-{uuid.uuid4()}")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def process_file(input_path, output_dir, params):
+    name = os.path.splitext(os.path.basename(input_path))[0]
+    cluster_path, outline_path, mapping_path = output_paths(output_dir, name, params["image_format"], params["outline_format"])
+
+    start = time.perf_counter()
+    with open(input_path, "rb") as f:
+        image_bytes = f.read()
+    cluster_image_bytes, outline_image_bytes, label_color_mapping = process_image(image_bytes=image_bytes, **params)
+
+    write_atomic(cluster_path, cluster_image_bytes)
+    write_atomic(outline_path, outline_image_bytes)
+    mapping = {str(k): [int(c) for c in v] for k, v in label_color_mapping.items()}
+    write_atomic(mapping_path, json.dumps(mapping).encode())
+    return len(image_bytes), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input_dir")
+    parser.add_argument("output_dir")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--n-clusters", type=int, default=20)
+    parser.add_argument("--blur-radius", type=float, default=1)
+    parser.add_argument("--fit-method", default="exact", choices=["exact", "sample", "minibatch"])
+    parser.add_argument("--denoise-backend", default="tv_bregman")
+    parser.add_argument("--max-working-edge", type=int)
+    parser.add_argument("--output-max-edge", type=int)
+    parser.add_argument("--image-format", default="png", choices=["png", "webp"])
+    parser.add_argument("--outline-format", default="raster", choices=["raster", "svg"])
+    parser.add_argument("--use-cache", action="store_true", help="Also read and fill the result and stage caches.")
+    args = parser.parse_args()
+
+    params = {
+        "n_clusters": args.n_clusters,
+        "blur_radius": args.blur_radius,
+        "fit_method": args.fit_method,
+        "denoise_backend": args.denoise_backend,
+        "max_working_edge": args.max_working_edge,
+        "output_max_edge": args.output_max_edge,
+        "use_cache": args.use_cache,
+        "image_format": args.image_format,
+        "outline_format": args.outline_format
+    }
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    input_paths = sorted(
+        os.path.join(args.input_dir, entry)
+        for entry in os.listdir(args.input_dir)
+        if entry.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    pending = [
+        path for path in input_paths
+        if not os.path.exists(output_paths(args.output_dir, os.path.splitext(os.path.basename(path))[0])[2])
+    ]
+    print(f"{len(input_paths)} images, {len(input_paths) - len(pending)} already done, {len(pending)} to process "
+          f"with {args.workers} workers")
+
+    start = time.perf_counter()
+    done = failed = total_bytes = 0
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_process_worker,
+                             initargs=(args.workers,)) as executor:
+        futures = {executor.submit(process_file, path, args.output_dir, params): path for path in pending}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                size, seconds = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"FAILED {os.path.basename(path)}: {e}")
+                continue
+
+            done += 1
+            total_bytes += size
+            elapsed = time.perf_counter() - start
+            print(f"[{done + failed}/{len(pending)}] {os.path.basename(path)} {seconds:.1f}s "
+                  f"({done / elapsed:.2f} images/s)")
+
+    elapsed = time.perf_counter() - start
+    print(f"Processed {done} images ({total_bytes / 1e6:.1f} MB) in {elapsed:.1f}s: "
+          f"{done / elapsed if elapsed else 0:.2f} images/s, {failed} failed")
+
+
+if __name__ == "__main__":
+    main()
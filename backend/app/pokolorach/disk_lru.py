@@ -0,0 +1,45 @@
+import os
+import shutil
+
+def cache_entries(cache_dir):
+    """
+    List the entries of a cache directory as (mtime, size, path) tuples.
+
+    An entry is a file or a directory of files; a directory's size is the sum
+    of its files. Names starting with "." are in-progress writes and are
+    skipped, as are entries removed while the directory is scanned.
+    """
+    entries = []
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if entry.name.startswith("."):
+                continue
+            try:
+                if entry.is_dir():
+                    size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                else:
+                    size = entry.stat().st_size
+                entries.append((entry.stat().st_mtime, size, entry.path))
+            except FileNotFoundError:
+                continue
+    return entries
+
+
+def evict_lru(cache_dir, max_bytes):
+    """
+    Remove the least recently used entries of cache_dir until it holds at
+    most max_bytes. Readers mark an entry as used by touching its mtime.
+    """
+    entries = sorted(cache_entries(cache_dir))
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total_bytes <= max_bytes:
+            break
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total_bytes -= size
@@ -0,0 +1,39 @@
+import os
+from io import BytesIO
+import numpy as np
+from PIL import Image
+
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "png")
+PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL", 6))
+WEBP_METHOD = int(os.getenv("WEBP_METHOD", 4))
+
+CONTENT_TYPES = {
+    "png": "image/png",
+    "webp": "image/webp",
+    "svg": "image/svg+xml",
+}
+
+
+def encode_indexed(index_map, palette, image_format=IMAGE_FORMAT, compress_level=PNG_COMPRESS_LEVEL):
+    """
+    Encode an image given as palette indices plus its palette.
+
+    Parameters:
+    - index_map (ndarray): uint8 array of palette indices, shape (height, width).
+    - palette (ndarray): RGB palette, shape (n, 3) with n <= 256.
+    - image_format (str): "png" for an indexed ("P" mode) PNG, or "webp" for a lossless WebP.
+    - compress_level (int): zlib level for PNG, 0 (none) to 9 (smallest).
+    """
+    if image_format not in ("png", "webp"):
+        raise ValueError(f"Unknown image_format: {image_format}. Expected 'png' or 'webp'.")
+
+    index_map = np.ascontiguousarray(index_map, dtype=np.uint8)
+    image = Image.frombytes("P", index_map.shape[::-1], index_map.tobytes())
+    image.putpalette(np.asarray(palette, dtype=np.uint8).ravel().tolist())
+
+    with BytesIO() as byte_stream:
+        if image_format == "png":
+            image.save(byte_stream, format="PNG", compress_level=compress_level)
+        else:
+            image.save(byte_stream, format="WEBP", lossless=True, method=WEBP_METHOD)
+        return byte_stream.getvalue()
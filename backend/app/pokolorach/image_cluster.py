@@ -1,6 +1,6 @@
 import numpy as np
-from PIL import Image, ImageFilter
-from sklearn.cluster import KMeans
+from PIL import Image, ImageFilter, ImageOps
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from skimage import measure, morphology, color
 from skimage.color import rgb2lab, lab2rgb
 from skimage.restoration import denoise_tv_bregman
@@ -11,11 +11,31 @@ import os
 import cv2
 import logging
 from collections import deque
-from app.database import save_image, update_image_entry, get_entry
+from .regions import RegionGraph
+from .stage_cache import run_stage
+from .tiles import map_row_bands
+from .encoding import IMAGE_FORMAT, encode_indexed
+from .instrumentation import stage
+
+FETCH_CONNECT_TIMEOUT = float(os.getenv("FETCH_CONNECT_TIMEOUT", 5))
+FETCH_READ_TIMEOUT = float(os.getenv("FETCH_READ_TIMEOUT", 30))
+FETCH_CHUNK_SIZE = 1024 * 1024
+
+# Shared across fetches in a process so connections to storage are reused.
+http_session = requests.Session()
+http_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8))
+http_session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8))
 
 class ImageProcessor:
-    def __init__(self, image_path=None, image_url=None):
-        if image_path:
+    # EXIF orientations that swap width and height
+    TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+    def __init__(self, image_path=None, image_url=None, image_bytes=None, max_edge=None):
+        self.max_edge = max_edge
+        self.original_size = None
+        if image_bytes is not None:
+            self.image = self.load_image_from_bytes(image_bytes)
+        elif image_path:
             self.image = self.load_image(image_path)
         elif image_url:
             self.image = self.load_image_from_url(image_url)
@@ -23,26 +43,112 @@ class ImageProcessor:
             raise ValueError("Either image_path or image_url must be provided.")
         
     def load_image(self, image_path):
-        image = Image.open(image_path)
-        image = image.convert("RGB")
-        return image
+        return self.decode(Image.open(image_path))
 
     def load_image_from_url(self, image_url):
-        response = requests.get(image_url)
-        image = Image.open(BytesIO(response.content))
-        image = image.convert("RGB")
-        return image
+        return self.load_image_from_bytes(self.fetch_image_bytes(image_url))
+
+    def load_image_from_bytes(self, image_bytes):
+        return self.decode(Image.open(BytesIO(image_bytes)))
+
+    def decode(self, image):
+        """
+        Decode an opened image to upright RGB.
+
+        original_size is set to the upright full-resolution size. If max_edge
+        is set, JPEGs are decoded at the smallest DCT scale that still covers
+        it, so large photos are never decoded in full; downscale() then brings
+        the image to the exact working size.
+        """
+        width, height = image.size
+        if image.getexif().get(0x0112, 1) in self.TRANSPOSED_ORIENTATIONS:
+            width, height = height, width
+        self.original_size = (width, height)
+
+        if self.max_edge and image.format == "JPEG":
+            image.draft("RGB", self.scaled_size(image.size, self.max_edge))
+        image = ImageOps.exif_transpose(image)
+        return image.convert("RGB")
+
+    @staticmethod
+    def read_image_bytes(image_path=None, image_url=None):
+        if image_path:
+            with open(image_path, "rb") as f:
+                return f.read()
+        elif image_url:
+            return ImageProcessor.fetch_image_bytes(image_url)
+        else:
+            raise ValueError("Either image_path or image_url must be provided.")
+
+    @staticmethod
+    def fetch_image_bytes(image_url):
+        timeout = (FETCH_CONNECT_TIMEOUT, FETCH_READ_TIMEOUT)
+        with http_session.get(image_url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            return b"".join(response.iter_content(chunk_size=FETCH_CHUNK_SIZE))
+
+    @staticmethod
+    def scaled_size(size, max_edge):
+        width, height = size
+        if not max_edge or max(width, height) <= max_edge:
+            return width, height
+        scale = max_edge / max(width, height)
+        return max(1, round(width * scale)), max(1, round(height * scale))
+
+    def downscale(self, max_edge):
+        size = self.scaled_size(self.image.size, max_edge)
+        if size != self.image.size:
+            self.image = self.image.resize(size, Image.LANCZOS)
+
+    # Denoising backend name -> (method name, halo rows needed around each band)
+    DENOISE_BACKENDS = {
+        "tv_bregman": ("denoise_tv_bregman", 32),
+        "bilateral": ("denoise_bilateral", 8),
+        "nl_means": ("denoise_nl_means", 16),
+    }
+
+    @staticmethod
+    def denoise_tv_bregman(image_array, weight):
+        denoised = denoise_tv_bregman(image_array.astype(np.float32) / 255, weight=weight)
+        return (denoised * 255).astype(np.uint8)
+
+    @staticmethod
+    def denoise_bilateral(image_array, weight):
+        denoised = cv2.bilateralFilter(image_array.astype(np.float32) / 255, d=9, sigmaColor=0.1 / weight, sigmaSpace=5)
+        return (np.clip(denoised, 0, 1) * 255).astype(np.uint8)
+
+    @staticmethod
+    def denoise_nl_means(image_array, weight):
+        # OpenCV's non-local means only accepts 8-bit input.
+        h = 10 / weight
+        return cv2.fastNlMeansDenoisingColored(np.ascontiguousarray(image_array), None, h, h, 7, 21)
+
+    def preprocess_image(self, denoise_weight=0.1, blur_radius=4, denoise_backend="tv_bregman"):
+        """
+        Denoise and blur the image.
+
+        Parameters:
+        - denoise_weight (float): Denoising weight. For every backend, smaller values smooth more.
+        - blur_radius (float): Radius for Gaussian blur.
+        - denoise_backend (str): "tv_bregman" (split Bregman total variation), "bilateral" (OpenCV bilateral filter)
+          or "nl_means" (OpenCV fast non-local means). The image is denoised in overlapping row bands on the tile thread pool.
+        """
+        if denoise_backend not in self.DENOISE_BACKENDS:
+            raise ValueError(f"Unknown denoise_backend: {denoise_backend}. Expected one of {list(self.DENOISE_BACKENDS)}.")
+        method_name, halo = self.DENOISE_BACKENDS[denoise_backend]
+        denoise = getattr(self, method_name)
 
-    def preprocess_image(self, denoise_weight=0.1, blur_radius=4):
         image_array = np.array(self.image)
-        denoised_image_array = denoise_tv_bregman(image_array, weight=denoise_weight)
-        denoised_image = Image.fromarray((denoised_image_array * 255).astype(np.uint8))
+        denoised_image_array = map_row_bands(lambda band: denoise(band, denoise_weight), image_array, halo=halo)
+        denoised_image = Image.fromarray(denoised_image_array)
         blurred_image = denoised_image.filter(ImageFilter.GaussianBlur(radius=blur_radius))
         return blurred_image
     
     @staticmethod
     def convert_to_bytes(image_array):
-        image = Image.fromarray((image_array * 255).astype(np.uint8) if image_array.max() <= 1 else image_array.astype(np.uint8))
+        if image_array.dtype != np.uint8:
+            image_array = (image_array * 255).astype(np.uint8) if image_array.max() <= 1 else image_array.astype(np.uint8)
+        image = Image.fromarray(image_array)
         with BytesIO() as byte_stream:
             image.save(byte_stream, format='PNG')
             return byte_stream.getvalue()
@@ -50,127 +156,253 @@ class ImageProcessor:
 class ColorClusterer:
     def __init__(self, image_array):
         self.image_array = image_array
-        self.lab_array = rgb2lab(image_array)
-    
-    def cluster_image(self, n_clusters=16):
-        x = self.lab_array[:, :, 0].flatten()
-        y = self.lab_array[:, :, 1].flatten()
-        z = self.lab_array[:, :, 2].flatten()
-        data = np.vstack((x, y, z)).T
-        
-        kmeans = KMeans(n_clusters=n_clusters, random_state=0, init="k-means++")
-        kmeans.fit(data)
-        
-        self.centers = kmeans.cluster_centers_
-        self.labels = kmeans.labels_
+        self.lab_array = map_row_bands(rgb2lab, image_array)
     
-    def map_clusters_to_image(self):
-        clustered_image = self.centers[self.labels]
-        return clustered_image.reshape(self.image_array.shape[:2] + (3,))
+    def cluster_image(self, n_clusters=16, fit_method="exact", sample_size=100000, init_centers=None):
+        """
+        Fit a palette of n_clusters Lab centres and assign every pixel to one.
 
-    def process_clusters_to_rgb(self, clustered_image):
-        return lab2rgb(clustered_image)
+        If init_centers is given, k-means is warm-started from them instead of
+        running k-means++ seeding, e.g. from the palette of a neighbouring
+        n_clusters. Missing centres are seeded k-means++ style from a pixel
+        sample; surplus ones are dropped, keeping the most spread-out set.
+        """
+        data = self.lab_array.reshape(-1, 3)
 
-    def apply_morphological_closing(self, clustered_image, kernel_size=(5, 5)):
-        kernel = np.ones(kernel_size, np.uint8)
-        
-        if clustered_image.ndim == 3 and clustered_image.shape[2] == 3:
-            closed_image = np.zeros_like(clustered_image)
-            for i in range(3):
-                closed_image[:, :, i] = morphology.closing(clustered_image[:, :, i], kernel)
-        else:
-            closed_image = morphology.closing(clustered_image, kernel)
-        
-        closed_image_flat = closed_image.reshape(-1, 3)
-        centers_flat = self.centers.reshape(-1, 3)
-        distances = np.linalg.norm(closed_image_flat[:, np.newaxis] - centers_flat, axis=2)
-        nearest_centers = np.argmin(distances, axis=1)
-        reassigned_image = self.centers[nearest_centers].reshape(closed_image.shape)
-        
-        return reassigned_image
+        init, n_init = "k-means++", None
+        if init_centers is not None:
+            init, n_init = self.resize_centers(init_centers, n_clusters, sample_size), 1
 
-class FacetProcessor:
-    def __init__(self, clustered_image):
-        self.clustered_image = clustered_image
+        if fit_method == "exact":
+            kmeans = KMeans(n_clusters=n_clusters, random_state=0, init=init, n_init=n_init or "auto")
+            kmeans.fit(data)
+            self.centers = kmeans.cluster_centers_
+            self.labels = kmeans.labels_
+            return
 
-    def remove_and_fill_small_facets(self, min_size):
-        if self.clustered_image.dtype != np.uint8:
-            image = (self.clustered_image * 255).astype(np.uint8)
+        if fit_method == "sample":
+            kmeans = KMeans(n_clusters=n_clusters, random_state=0, init=init, n_init=n_init or "auto")
+            kmeans.fit(self.sample_pixels(sample_size))
+        elif fit_method == "minibatch":
+            kmeans = MiniBatchKMeans(n_clusters=n_clusters, random_state=0, init=init,
+                                     batch_size=4096, n_init=n_init or 3)
+            kmeans.fit(data.astype(np.float32))
         else:
-            image = self.clustered_image.copy()
+            raise ValueError(f"Unknown fit_method: {fit_method}. Expected 'exact', 'sample' or 'minibatch'.")
 
-        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        self.centers = kmeans.cluster_centers_.astype(np.float64)
+        self.labels = self.assign_labels(data, self.centers)
 
-        labeled_image = measure.label(gray_image)
-        
-        cleaned_labels = morphology.remove_small_objects(labeled_image, min_size=min_size)
+    def resize_centers(self, centers, n_clusters, sample_size=100000):
+        centers = np.asarray(centers, dtype=np.float64)
+        rng = np.random.default_rng(0)
+
+        if len(centers) > n_clusters:
+            # Farthest-point subset, starting from the first centre
+            keep = [0]
+            distances = np.linalg.norm(centers - centers[0], axis=1)
+            while len(keep) < n_clusters:
+                keep.append(int(np.argmax(distances)))
+                distances = np.minimum(distances, np.linalg.norm(centers - centers[keep[-1]], axis=1))
+            return centers[keep]
+
+        if len(centers) < n_clusters:
+            # k-means++ seeding of the extra centres around the existing ones
+            sample = self.sample_pixels(sample_size).astype(np.float64)
+            distances = ((sample[:, None, :] - centers[None]) ** 2).sum(axis=2).min(axis=1)
+            extra = []
+            for _ in range(n_clusters - len(centers)):
+                total = distances.sum()
+                index = rng.choice(len(sample), p=distances / total) if total > 0 else rng.integers(len(sample))
+                extra.append(sample[index])
+                distances = np.minimum(distances, ((sample - sample[index]) ** 2).sum(axis=1))
+            centers = np.vstack([centers, extra])
+
+        return centers
+
+    def sample_pixels(self, sample_size):
+        # Stratified sample: one randomly jittered pixel per cell of a regular
+        # grid, so every part of the image contributes to the palette.
+        height, width = self.lab_array.shape[:2]
+        step = max(1, int(np.sqrt(height * width / sample_size)))
+        rng = np.random.default_rng(0)
+        grid_y, grid_x = np.meshgrid(np.arange(0, height, step), np.arange(0, width, step), indexing="ij")
+        grid_y = np.minimum(grid_y + rng.integers(0, step, grid_y.shape), height - 1)
+        grid_x = np.minimum(grid_x + rng.integers(0, step, grid_x.shape), width - 1)
+        return self.lab_array[grid_y, grid_x].reshape(-1, 3).astype(np.float32)
+
+    @staticmethod
+    def nearest_centers(data, centers, dtype=np.int32, chunk_size=262144):
+        # Single-threaded; data is (n, 3) and centers are float32
+        centers_sq = np.einsum("ij,ij->i", centers, centers)
+        labels = np.empty(data.shape[0], dtype=dtype)
+        for start in range(0, data.shape[0], chunk_size):
+            chunk = data[start:start + chunk_size].astype(np.float32)
+            # ||x - c||^2 without the ||x||^2 term, which is constant per pixel.
+            distances = centers_sq - 2 * chunk @ centers.T
+            labels[start:start + chunk_size] = np.argmin(distances, axis=1)
+        return labels
+
+    @staticmethod
+    def assign_labels(data, centers, chunk_size=262144):
+        centers = centers.astype(np.float32)
+        return map_row_bands(lambda band: ColorClusterer.nearest_centers(band, centers, chunk_size=chunk_size),
+                             data.reshape(-1, 3), min_rows=chunk_size)
+
+    def process_clusters_to_rgb(self, clustered_image):
+        return lab2rgb(clustered_image)
 
-        mask = cleaned_labels > 0
+    def get_palette(self):
+        rgb_centers = self.process_clusters_to_rgb(self.centers[np.newaxis])[0]
+        return (rgb_centers * 255).astype(np.uint8)
 
-        cleaned_image = image.copy()
-        cleaned_image[~mask] = 0
+    def apply_morphological_closing(self, kernel_size=(5, 5), band_rows=128):
+        """
+        Close the image of cluster centre colours and reassign every pixel to
+        its nearest centre, returning the uint8 label map.
 
-        if self.clustered_image.dtype != np.uint8:
-            cleaned_image = cleaned_image.astype(self.clustered_image.dtype) / 255.0
+        The centre-colour image, its closed copy and the distances only exist
+        per band of band_rows rows, so the only full-size arrays are the uint8
+        label map and its bands.
+        """
+        kernel = np.ones(kernel_size, np.uint8)
+        centers = self.centers.astype(np.float32)
+        labels = self.labels.reshape(self.image_array.shape[:2])
 
-        black_pixel_mask = np.all(cleaned_image == [0, 0, 0], axis=-1)
-        black_pixel_indices = np.argwhere(black_pixel_mask)
+        def close_band(band):
+            # OpenCV closes every channel of a float32 image in one call
+            closed = cv2.morphologyEx(centers[band], cv2.MORPH_CLOSE, kernel)
+            return self.nearest_centers(closed.reshape(-1, 3), centers, np.uint8, chunk_size=32768).reshape(band.shape)
 
-        for y, x in black_pixel_indices:
-            if x > 0:
-                if np.all(cleaned_image[y, x - 1] == [0, 0, 0]) and y > 0:
-                    cleaned_image[y, x] = cleaned_image[y - 1, x]
-                else:
-                    cleaned_image[y, x] = cleaned_image[y, x - 1]
-            else:
-                if x < cleaned_image.shape[1] - 1:
-                    if np.all(cleaned_image[y, x + 1] == [0, 0, 0]) and y > 0:
-                        cleaned_image[y, x] = cleaned_image[y - 1, x]
-                    else:
-                        cleaned_image[y, x] = cleaned_image[y, x + 1]
+        # Dilation and erosion each reach kernel_size // 2 rows, so a pixel of
+        # the closed image depends on rows up to twice that far away.
+        label_map = map_row_bands(close_band, labels, halo=2 * (kernel_size[0] // 2), max_rows=band_rows)
+        self.labels = label_map.ravel()
+        return label_map
 
-        return cleaned_image
+class FacetProcessor:
+    def __init__(self, region_graph):
+        self.region_graph = region_graph
+
+    def remove_and_fill_small_facets(self, min_size):
+        # Facets smaller than min_size are merged into the neighbouring facet
+        # they share the longest boundary with. Every palette index, including
+        # the one for black, forms its own facets.
+        is_kept = self.region_graph.areas >= min_size
+        if is_kept[1:].all():
+            return self.region_graph
+
+        target, _ = self.region_graph.merge_targets(is_kept)
+        self.region_graph.merge(target)
+        return self.region_graph
 
 class ClusteredImageCreator:
-    def __init__(self, image_path=None, image_url=None, n_clusters=16, blur_radius=4, denoise_weight=0.1, min_size=300, file_name=None, entry_id=None, file_options=None):
+    def __init__(self, image_path=None, image_url=None, image_bytes=None, n_clusters=16, blur_radius=4, denoise_weight=0.1, min_size=300,
+                 fit_method="exact", sample_size=100000, stage_cache=None, image_key=None, max_working_edge=None, output_max_edge=None,
+                 denoise_backend="tv_bregman", warm_start=False, image_format=IMAGE_FORMAT):
         self.image_path = image_path
         self.image_url = image_url
+        self.image_bytes = image_bytes
         self.n_clusters = n_clusters
+        self.fit_method = fit_method
+        self.sample_size = sample_size
         self.blur_radius = blur_radius
         self.denoise_weight = denoise_weight
+        self.denoise_backend = denoise_backend
         self.min_size = min_size
-        self.file_name = file_name
-        self.entry_id = entry_id
-        self.file_options = file_options
-        self.clustered_image = None
+        # With warm_start, each create_cluster() call after the first seeds
+        # k-means with the previous call's palette, for sweeping n_clusters.
+        self.warm_start = warm_start
+        self.image_format = image_format
+        self.max_working_edge = max_working_edge
+        self.output_max_edge = output_max_edge
+        # Stages are only memoized when the input is identified by image_key.
+        self.stage_cache = stage_cache if image_key else None
+        self.image_key = image_key
+        self.region_graph = None
+        self.region_graph_key = None
+        self.palette = None
+        self.cluster_key = None
+        self.preprocessed = None
+        self.color_clusterer = None
+        self.output_scale = 1.0
+        self.cluster_image_bytes = None
+
+    def preprocess(self):
+        with stage("decode"):
+            image_processor = ImageProcessor(self.image_path, self.image_url, self.image_bytes, max_edge=self.max_working_edge)
+            original_size = image_processor.original_size
+            image_processor.downscale(self.max_working_edge)
+        with stage("denoise", image_processor.image.size):
+            processed_image = image_processor.preprocess_image(self.denoise_weight, self.blur_radius, self.denoise_backend)
+        return np.array(processed_image), original_size
+
+    def cluster(self, processed_image_array, init_centers=None):
+        size = processed_image_array.shape[1::-1]
+        # The Lab conversion is kept for later calls on the same image
+        if self.color_clusterer is None or self.color_clusterer.image_array is not processed_image_array:
+            with stage("lab_conversion", size):
+                self.color_clusterer = ColorClusterer(processed_image_array)
+        color_clusterer = self.color_clusterer
+        with stage("kmeans", size):
+            color_clusterer.cluster_image(self.n_clusters, self.fit_method, self.sample_size, init_centers)
+
+        with stage("closing", size):
+            label_map = color_clusterer.apply_morphological_closing()
+        return label_map, color_clusterer.get_palette()
 
     def create_cluster(self):
-        # Process the image
-        image_processor = ImageProcessor(self.image_path, self.image_url)
-        processed_image = image_processor.preprocess_image(self.denoise_weight, self.blur_radius)
-        processed_image_array = np.array(processed_image)
+        # Process the image, once per creator
+        if self.preprocessed is None:
+            self.preprocessed = run_stage(
+                self.stage_cache, "preprocess", self.image_key,
+                {"denoise_weight": self.denoise_weight, "blur_radius": self.blur_radius, "max_working_edge": self.max_working_edge,
+                 "denoise_backend": self.denoise_backend},
+                self.preprocess)
+        preprocess_key, (processed_image_array, original_size) = self.preprocessed
 
         # Check image dimensions
-        if processed_image_array.shape[0] < self.min_size or processed_image_array.shape[1] < self.min_size:
-            raise ValueError(f"Image dimensions must be at least {self.min_size}x{self.min_size} pixels. Current dimensions: {processed_image_array.shape[1]}x{processed_image_array.shape[0]}.")
+        width, height = original_size
+        if height < self.min_size or width < self.min_size:
+            raise ValueError(f"Image dimensions must be at least {self.min_size}x{self.min_size} pixels. Current dimensions: {width}x{height}.")
 
-        # Cluster the image
-        color_clusterer = ColorClusterer(processed_image_array)
-        color_clusterer.cluster_image(self.n_clusters)
+        # min_size is an area at native resolution; rescale it to the working copy
+        working_scale = processed_image_array.shape[1] / width
+        working_min_size = max(1, round(self.min_size * working_scale ** 2))
 
-        clustered_lab_image = color_clusterer.map_clusters_to_image()
-        closed_clustered_lab_image = color_clusterer.apply_morphological_closing(clustered_lab_image)
-        self.clustered_image = color_clusterer.process_clusters_to_rgb(closed_clustered_lab_image)
+        if self.n_clusters > 255:
+            raise ValueError(f"n_clusters must be at most 255 to fit a uint8 label map. Got {self.n_clusters}.")
 
-        facet_processor = FacetProcessor(self.clustered_image)
-        self.clustered_image = facet_processor.remove_and_fill_small_facets(self.min_size)
+        # Cluster the image; Lab conversion and closing run inside this stage
+        cluster_params = {"n_clusters": self.n_clusters, "fit_method": self.fit_method, "sample_size": self.sample_size}
+        init_centers = None
+        if self.warm_start and self.palette is not None:
+            init_centers = rgb2lab(self.palette[np.newaxis])[0]
+            cluster_params["init_from"] = self.cluster_key
+        self.cluster_key, (label_map, self.palette) = run_stage(
+            self.stage_cache, "cluster", preprocess_key, cluster_params,
+            lambda: self.cluster(processed_image_array, init_centers))
 
-        # Save and update image
-        clustered_image_bytes = ImageProcessor.convert_to_bytes(self.clustered_image)
-        response, image_url = save_image(storage_path="cluster_image", file_contents=clustered_image_bytes, filename=self.file_name, file_options=self.file_options)
-        update_image_entry(table_name="Entries", image_url=image_url, entry_id=self.entry_id, column="img_cluster_url")
-        img_cluster_url = get_entry(table_name="Entries", entry_id=self.entry_id, column="img_cluster_url")
+        # The region graph is the only full-image labelling pass; facet cleanup,
+        # label placement and outlining all work from it.
+        facets_key, region_graph = run_stage(
+            self.stage_cache, "facets", self.cluster_key, {"min_size": working_min_size},
+            lambda: FacetProcessor(RegionGraph(label_map)).remove_and_fill_small_facets(working_min_size))
 
-        return self.clustered_image, img_cluster_url
+        # Bring the regions to the output resolution. At the working resolution
+        # the facets graph is used as is, so it is not cached a second time.
+        output_size = ImageProcessor.scaled_size(original_size, self.output_max_edge)
+        self.output_scale = output_size[0] / width
+        if output_size == processed_image_array.shape[1::-1]:
+            self.region_graph_key, self.region_graph = facets_key, region_graph
+        else:
+            self.region_graph_key, self.region_graph = run_stage(
+                self.stage_cache, "upsample", facets_key, {"output_size": list(output_size)},
+                lambda: region_graph.resized(output_size))
 
+        # Encode the image
+        _, self.cluster_image_bytes = run_stage(
+            self.stage_cache, "encode_cluster", self.region_graph_key, {"image_format": self.image_format},
+            lambda: encode_indexed(self.region_graph.value_map(), self.palette, self.image_format))
 
+        return self.region_graph, self.palette, self.cluster_image_bytes
@@ -1,25 +1,15 @@
 import numpy as np
 import cv2
-from skimage.measure import label, regionprops
-import requests
-from io import BytesIO
 from copy import deepcopy
-from PIL import Image
-from app.database import save_image, update_image_entry, get_entry
-
-class ImagePreprocessor:
-    @staticmethod
-    def preprocess_image(image):
-        if image.dtype != np.uint8:
-            if image.max() <= 1.0:
-                image = (image * 255).astype(np.uint8)
-            else:
-                image = np.clip(image, 0, 255).astype(np.uint8)
-        return image
+from .stage_cache import run_stage
+from .tiles import map_row_bands
+from .encoding import IMAGE_FORMAT, encode_indexed
+from .svg_outline import SvgOutline
+from .instrumentation import stage
 
 class ImageOutline:
-    def __init__(self, image, line_size=3, blur_value=3, area_threshold_factor=150):
-        self.image = image
+    def __init__(self, palette, line_size=3, blur_value=3, area_threshold_factor=150):
+        self.palette = palette
         self.line_size = line_size
         self.blur_value = blur_value
         self.area_threshold_factor = area_threshold_factor
@@ -31,39 +21,18 @@ class ImageOutline:
         counts = np.bincount(vicinity_values)
         return np.argmax(counts)
 
-    def are_neighbors_same(self, mat, x, y):
-        width = mat.shape[1]
-        height = mat.shape[0]
-        val = mat[y, x]
-        neighbors = [(x + 1, y), (x, y + 1)]
-        
-        for xx, yy in neighbors:
-            if 0 <= xx < width and 0 <= yy < height:
-                if mat[yy, xx] != val:
-                    return False
-        return True
+    def boundary_mask(self, mat):
+        def band_mask(band):
+            mask = np.zeros(band.shape, dtype=bool)
+            mask[:, :-1] |= band[:, :-1] != band[:, 1:]
+            mask[:-1, :] |= band[:-1, :] != band[1:, :]
+            return mask
+
+        # A pixel only looks at the row below it, so one halo row per band suffices.
+        return map_row_bands(band_mask, mat, halo=1)
 
     def outline(self, mat):
-        height, width = mat.shape
-        line_mat = np.zeros((height, width), dtype=np.uint8)
-        outlined_pixels = set()
-
-        for y in range(height):
-            for x in range(width):
-                if (x, y) in outlined_pixels:
-                    continue
-                
-                if self.are_neighbors_same(mat, x, y):
-                    if (x + 1 < width and mat[y, x] != mat[y, x + 1]) or \
-                       (y + 1 < height and mat[y, x] != mat[y + 1, x]):
-                        line_mat[y, x] = 162
-                        outlined_pixels.add((x, y))
-                    else:
-                        line_mat[y, x] = 255
-                else:
-                    line_mat[y, x] = 162
-
-        return line_mat
+        return np.where(self.boundary_mask(mat), 162, 255).astype(np.uint8)
 
     def getRegion(self, mat, cov, x, y):
         covered = deepcopy(cov)
@@ -88,13 +57,7 @@ class ImageOutline:
         return region
     
     def getRegionColor(self, mat, region):
-        y_coords = np.array(region['y'])
-        x_coords = np.array(region['x'])
-        colors = [self.image[y, x] for x, y in zip(x_coords, y_coords)]
-        colors = np.array(colors)
-        unique_colors, counts = np.unique(colors, axis=0, return_counts=True)
-        most_frequent_color = unique_colors[counts.argmax()]
-        return tuple(most_frequent_color)
+        return tuple(self.palette[region['value']])
 
     def coverRegion(self, covered, region):
         for i in range(len(region['x'])):
@@ -109,89 +72,85 @@ class ImageOutline:
             y += incY
         return count
 
-    def getLabelLoc(self, mat, region):
-        x_center = np.mean(region['x']).astype(int)
-        y_center = np.mean(region['y']).astype(int)
-        
-        x_min, x_max = np.min(region['x']), np.max(region['x'])
-        y_min, y_max = np.min(region['y']), np.max(region['y'])
-        
-        label_width = 20
-        label_height = 20
-        
-        if (x_center - label_width // 2 >= x_min and x_center + label_width // 2 <= x_max and
-            y_center - label_height // 2 >= y_min and y_center + label_height // 2 <= y_max):
-            return {'value': region['value'], 'x': x_center, 'y': y_center}
-        else:
-            return None
-
-    def getBelowValue(self, mat, region):
-        y_max = mat.shape[0] - 1
-        x = region['x'][0]
-        y = min(region['y'][0] + 1, y_max)
-        while y < mat.shape[0] and mat[y, x] == region['value']:
-            y += 1
-        return mat[min(y, y_max), x]
-
-    def removeRegion(self, mat, region):
-        newValue = self.getBelowValue(mat, region)
-        for x, y in zip(region['x'], region['y']):
-            mat[y, x] = newValue
-
-    def getLabelLocs(self, mat, area_threshold):
-        height, width = mat.shape
-        covered = np.zeros((height, width), dtype=bool)
-
-        label_locs = []
-        label_color_mapping = {} 
-        new_label = 1
+    def clearance_map(self, mat):
+        # Distance from every pixel to the nearest outline pixel or image border
+        interior = np.pad(~self.boundary_mask(mat), 1).astype(np.uint8)
+        return cv2.distanceTransform(interior, cv2.DIST_L2, 5)[1:-1, 1:-1]
+
+    def getLabelLocs(self, region_graph, area_threshold):
+        region_values = region_graph.values.astype(np.int64)
+        is_large = region_graph.areas > area_threshold
+
+        # Number the palette colours of large regions in order of first appearance
+        large_regions = np.flatnonzero(is_large)
+        unique_values, first_index = np.unique(region_values[large_regions], return_index=True)
+        ordered_values = unique_values[np.argsort(first_index)]
+
+        new_labels = np.zeros(max(len(self.palette), int(region_values.max()) + 1), dtype=np.uint8)
+        new_labels[ordered_values] = np.arange(1, len(ordered_values) + 1)
+        label_color_mapping = {new_label: self.getRegionColor(None, {'value': value})
+                               for new_label, value in enumerate(ordered_values, start=1)}
+
+        # Small regions join the large region they share the longest boundary
+        # with; the matrix is then built with one lookup, regions that touch no
+        # large region getting 0.
+        target, resolved = region_graph.merge_targets(is_large)
+        region_new_labels = np.where(resolved, new_labels[region_values[target]], 0).astype(np.uint8)
+        region_map = region_graph.region_map()
+        mat = region_new_labels[region_map]
+
+        # Each label goes at its region's pole of inaccessibility: the pixel
+        # farthest from the region's outline, found for all regions at once
+        # from a single distance transform.
+        final_regions = target[region_map].ravel()
+        clearance = self.clearance_map(mat).ravel()
+        max_clearance = np.zeros(region_graph.num_regions, dtype=clearance.dtype)
+        np.maximum.at(max_clearance, final_regions, clearance)
+        candidates = np.flatnonzero(clearance == max_clearance[final_regions])
+        candidate_regions, first_candidate = np.unique(final_regions[candidates], return_index=True)
+        pole_index = np.zeros(region_graph.num_regions, dtype=np.int64)
+        pole_index[candidate_regions] = candidates[first_candidate]
 
-        labeled_mat, num_features = label(mat, return_num=True, connectivity=1)
-        regions = regionprops(labeled_mat)
-
-        label_mapping = {}
-
-        for region in regions:
-            if region.area > area_threshold:
-                y, x = region.coords[0]
-                old_label = mat[y, x]
-                if old_label not in label_mapping:
-                    color = self.getRegionColor(mat, {'x': region.coords[:, 1], 'y': region.coords[:, 0]})
-                    label_mapping[old_label] = (new_label, color)
-                    label_color_mapping[new_label] = color
-                    new_label += 1
+        width = mat.shape[1]
+        label_locs = [{'value': int(new_labels[region_values[region]]),
+                       'x': int(pole_index[region] % width),
+                       'y': int(pole_index[region] // width),
+                       'clearance': float(max_clearance[region])}
+                      for region in large_regions]
 
-                new_region_label, _ = label_mapping[old_label]
-                label_locs.append(self.getLabelLoc(mat, {'value': new_region_label, 'x': region.coords[:, 1], 'y': region.coords[:, 0]}))
+        return label_locs, label_color_mapping, mat
 
-        for region in regions:
-            if region.area > area_threshold:
-                old_label = mat[region.coords[0][0], region.coords[0][1]]
-                new_region_label, _ = label_mapping[old_label]
-                for coord in region.coords:
-                    mat[coord[0], coord[1]] = new_region_label
-            else:
-                self.removeRegion(mat, {'value': mat[region.coords[0][0], region.coords[0][1]], 'x': region.coords[:, 1], 'y': region.coords[:, 0]})
+class ImageAnnotator:
+    @staticmethod
+    def base_font_scale(height, width, font_scale_small, font_scale_medium, font_scale_large):
+        if height < 500 or width < 500:
+            return font_scale_small
+        elif height < 1000 or width < 1000:
+            return font_scale_medium
+        return font_scale_large
 
-        return label_locs, label_color_mapping
+    @staticmethod
+    def label_font_scale(text, label_info, font_scale, font_scale_small, thickness):
+        # Shrink the text until its box fits within the region's
+        # clearance, but never below the small-image scale.
+        (text_width, text_height), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 1, thickness)
+        fitting_scale = label_info.get('clearance', np.inf) / (0.5 * np.hypot(text_width, text_height))
+        return max(min(font_scale, fitting_scale), min(font_scale_small, font_scale))
 
-class ImageAnnotator:
     @staticmethod
     def draw_labels(image, label_locs, font_scale_small, font_scale_medium, font_scale_large, thickness):
         height, width = image.shape[:2]
-        
-        if height < 500 or width < 500:
-            font_scale = font_scale_small
-        elif height < 1000 or width < 1000:
-            font_scale = font_scale_medium
-        else:
-            font_scale = font_scale_large
+        font_scale = ImageAnnotator.base_font_scale(height, width, font_scale_small, font_scale_medium, font_scale_large)
 
         for label_info in label_locs:
             if label_info is not None:
-                position = (label_info['x'], label_info['y'])
-                cv2.putText(image, str(label_info['value']), position,
-                            cv2.FONT_HERSHEY_SIMPLEX, font_scale, (0, 0, 0), thickness, cv2.LINE_AA)
+                text = str(label_info['value'])
+                label_font_scale = ImageAnnotator.label_font_scale(text, label_info, font_scale, font_scale_small, thickness)
+
+                (text_width, text_height), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, label_font_scale, thickness)
+                position = (label_info['x'] - text_width // 2, label_info['y'] + text_height // 2)
+                cv2.putText(image, text, position,
+                            cv2.FONT_HERSHEY_SIMPLEX, label_font_scale, (0, 0, 0), thickness, cv2.LINE_AA)
         
         return image
 
@@ -209,12 +168,14 @@ class ImageEdgeProcessor:
         return cv2.bitwise_and(image, image, mask=mask)
 
 class OutlineCreator:
-    def __init__(self, file_name=None, entry_id=None, image=None, line_size=3, blur_value=3, filter_size=4, area_threshold_factor=150,
+    TEXT_LEVELS = 128
+
+    def __init__(self, region_graph=None, palette=None, line_size=3, blur_value=3, filter_size=4, area_threshold_factor=150,
                  outline_color=(162, 162, 162), font_scale_small=0.2, font_scale_medium=0.3,
-                 font_scale_large=0.5, thickness=1, min_size=500, file_options=None):
-        self.file_name = file_name
-        self.entry_id = entry_id
-        self.image = image
+                 font_scale_large=0.5, thickness=1, stage_cache=None, region_graph_key=None, image_format=IMAGE_FORMAT,
+                 outline_format="raster"):
+        self.region_graph = region_graph
+        self.palette = palette
         self.line_size = line_size
         self.blur_value = blur_value
         self.filter_size = filter_size
@@ -224,45 +185,63 @@ class OutlineCreator:
         self.font_scale_medium = font_scale_medium
         self.font_scale_large = font_scale_large
         self.thickness = thickness
-        self.min_size = min_size
-        self.file_options = file_options
-
-    @staticmethod
-    def convert_to_bytes(image_array):
-        image = Image.fromarray(image_array)
-        with BytesIO() as byte_stream:
-            image.save(byte_stream, format='PNG')
-            return byte_stream.getvalue()
+        # Stages are only memoized when the regions are identified by region_graph_key.
+        self.stage_cache = stage_cache if region_graph_key else None
+        self.region_graph_key = region_graph_key
+        self.image_format = image_format
+        self.outline_format = outline_format
+        self.outline_palette = None
+        self.outline_image_bytes = None
 
     def create_outline(self):
-            height, width = self.image.shape[:2]
+            # The minimum input size is checked on the native image by
+            # ClusteredImageCreator; the raster here may be downscaled by output_max_edge.
+            height, width = self.region_graph.raster.shape
 
-            self.image = ImagePreprocessor.preprocess_image(self.image)
+            area_threshold = max(height, width) // self.area_threshold_factor
 
-            if height < self.min_size or width < self.min_size:
-                raise ValueError(f"Image dimensions must be at least {self.min_size}x{self.min_size} pixels. Current dimensions: {width}x{height}.")
+            image_outline = ImageOutline(self.palette, self.line_size, self.blur_value, self.area_threshold_factor)
 
-            area_threshold = max(height, width) // self.area_threshold_factor
+            _, (label_locs, label_color_mapping, mat) = run_stage(
+                self.stage_cache, "label_locs", self.region_graph_key,
+                {"area_threshold_factor": self.area_threshold_factor},
+                lambda: image_outline.getLabelLocs(self.region_graph, area_threshold))
 
-            mat = cv2.cvtColor(self.image, cv2.COLOR_RGB2GRAY)
+            if self.outline_format == "svg":
+                return self.create_outline_svg(mat, label_locs, label_color_mapping)
+            elif self.outline_format != "raster":
+                raise ValueError(f"Unknown outline_format: {self.outline_format}. Expected 'raster' or 'svg'.")
 
-            image_outline = ImageOutline(self.image, self.line_size, self.blur_value, self.area_threshold_factor)
-            label_locs, label_color_mapping = image_outline.getLabelLocs(mat, area_threshold)
+            with stage("annotate", (width, height)):
+                # Labels are drawn on their own single-channel layer, where 255 is
+                # blank and lower values are anti-aliased text coverage.
+                text_layer = np.full((height, width), 255, dtype=np.uint8)
+                ImageAnnotator.draw_labels(text_layer, label_locs, self.font_scale_small,
+                                           self.font_scale_medium, self.font_scale_large, self.thickness)
 
-            outlined_image = image_outline.outline(mat)
+            with stage("outline", (width, height)):
+                # The outline only has two base colours, each darkened by text
+                # coverage, so it fits a palette image with TEXT_LEVELS shades each.
+                levels = self.TEXT_LEVELS
+                shades = np.linspace(0, 1, levels)[:, np.newaxis]
+                self.outline_palette = np.vstack([shades * (255, 255, 255), shades * np.array(self.outline_color)]).round().astype(np.uint8)
+                final_image_with_labels = ((text_layer.astype(np.uint16) * (levels - 1) + 127) // 255).astype(np.uint8)
+                final_image_with_labels[image_outline.boundary_mask(mat)] += levels
 
-            blank_image = np.ones((height, width, 3), dtype=np.uint8) * 255
-            for y in range(height):
-                for x in range(width):
-                    if outlined_image[y, x] == 162:
-                        blank_image[y, x] = self.outline_color
+            with stage("encode_outline", (width, height)):
+                self.outline_image_bytes = encode_indexed(final_image_with_labels, self.outline_palette, self.image_format)
 
-            final_image_with_labels = ImageAnnotator.draw_labels(blank_image, label_locs, self.font_scale_small,
-                                                                self.font_scale_medium, self.font_scale_large, self.thickness)
-            
-            outline_image = OutlineCreator.convert_to_bytes(image_array=final_image_with_labels)
-            response, image_url = save_image(storage_path="outline_image", file_contents=outline_image, filename=self.file_name, file_options=self.file_options)
-            update_image_entry(table_name="Entries", image_url=image_url, entry_id=self.entry_id, column="img_outline_url")
-            img_outline_url = get_entry(table_name="Entries", entry_id=self.entry_id, column="img_outline_url")
+            return final_image_with_labels, self.outline_image_bytes, label_color_mapping
 
-            return final_image_with_labels, img_outline_url, label_color_mapping
+    def create_outline_svg(self, mat, label_locs, label_color_mapping):
+        height, width = mat.shape
+        font_scale = ImageAnnotator.base_font_scale(height, width, self.font_scale_small,
+                                                    self.font_scale_medium, self.font_scale_large)
+        label_font_scales = [ImageAnnotator.label_font_scale(str(label_info['value']), label_info, font_scale,
+                                                             self.font_scale_small, self.thickness)
+                             for label_info in label_locs]
+
+        svg_outline = SvgOutline(self.outline_color)
+        with stage("svg_outline", (width, height)):
+            self.outline_image_bytes = svg_outline.to_svg(mat, label_locs, label_font_scales)
+        return mat, self.outline_image_bytes, label_color_mapping
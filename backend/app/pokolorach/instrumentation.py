@@ -0,0 +1,96 @@
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# tracemalloc slows allocation-heavy stages down by up to 2x, so memory is
+# only traced when asked for.
+TRACE_MEMORY = os.getenv("TRACE_MEMORY", "0") == "1"
+
+current_trace = ContextVar("current_trace", default=None)
+
+class Trace:
+    """
+    Collects one record per instrumented stage run while it is active.
+
+    Each record holds the stage name, wall and CPU seconds, the peak bytes
+    allocated above the stage's starting point (tracked with tracemalloc when
+    memory is True) and the image size the stage worked on, if known. Stages
+    may nest; a stage's peak includes the peaks of the stages inside it.
+    Memory tracking assumes one trace runs at a time in the process, so it is
+    meant for worker processes, not for concurrent tasks on an event loop.
+    If on_stage is given, it is called with each record as its stage finishes.
+    """
+    def __init__(self, memory=TRACE_MEMORY, on_stage=None):
+        self.memory = memory
+        self.on_stage = on_stage
+        self.records = []
+        self.frames = []
+        self.token = None
+        self.started_tracemalloc = False
+
+    def __enter__(self):
+        self.token = current_trace.set(self)
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+        return self
+
+    def __exit__(self, *exc_info):
+        current_trace.reset(self.token)
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+    def enter_frame(self):
+        if not self.memory:
+            return None
+        current, peak = tracemalloc.get_traced_memory()
+        for frame in self.frames:
+            frame["peak"] = max(frame["peak"], peak)
+        tracemalloc.reset_peak()
+        frame = {"start": current, "peak": current}
+        self.frames.append(frame)
+        return frame
+
+    def exit_frame(self, frame):
+        if frame is None:
+            return None
+        _, peak = tracemalloc.get_traced_memory()
+        frame["peak"] = max(frame["peak"], peak)
+        self.frames.remove(frame)
+        for parent in self.frames:
+            parent["peak"] = max(parent["peak"], frame["peak"])
+        tracemalloc.reset_peak()
+        return frame["peak"] - frame["start"]
+
+
+@contextmanager
+def stage(name, size=None):
+    """
+    Record the wall time, CPU time and peak memory of the enclosed block as
+    stage name in the current trace. size is the (width, height) the stage
+    works on. Does nothing outside a trace.
+    """
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    frame = trace.enter_frame()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        record = {
+            "stage": name,
+            "wall_seconds": time.perf_counter() - wall_start,
+            "cpu_seconds": time.process_time() - cpu_start,
+            "peak_bytes": trace.exit_frame(frame),
+        }
+        if size is not None:
+            record["width"], record["height"] = int(size[0]), int(size[1])
+        trace.records.append(record)
+        if trace.on_stage is not None:
+            trace.on_stage(record)
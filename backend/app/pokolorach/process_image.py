@@ -1,11 +1,17 @@
-from .image_cluster import ClusteredImageCreator
+import hashlib
+from .image_cluster import ClusteredImageCreator, ImageProcessor
 from .image_outline import OutlineCreator
+from .blob_cache import blob_cache
+from .result_cache import ResultCache, result_cache
+from .stage_cache import stage_cache
+from .encoding import IMAGE_FORMAT
+from .instrumentation import stage
 
 def process_image(
     file_name=None,
-    entry_id=None,
-    file_options=None,
     image_url=None,
+    image_bytes=None,
+    upload_id=None,
     n_clusters=16,
     blur_radius=4,
     line_size=3,
@@ -18,14 +24,31 @@ def process_image(
     font_scale_large=0.5,
     thickness=1,
     min_size=300,
-    denoise_weight=1
+    denoise_weight=1,
+    denoise_backend="tv_bregman",
+    fit_method="exact",
+    sample_size=100000,
+    use_cache=True,
+    max_working_edge=None,
+    output_max_edge=None,
+    n_clusters_list=None,
+    image_format=IMAGE_FORMAT,
+    outline_format="raster",
+    on_cluster=None
 ):
     """
     Main function to process an image with clustering and outlining.
 
+    Returns the encoded cluster image, the encoded outline image and the label colour mapping.
+    With n_clusters_list, returns a list of such tuples, one per entry.
+    Nothing is uploaded; storing the results is up to the caller.
+
     Parameters:
     - file_name (str): Base name of the image file (without extension). Use this if image_url is not provided.
     - image_url (str): URL of the image file. Use this if file_name is not provided.
+      It is only fetched if the image bytes are not available locally.
+    - image_bytes (bytes): Encoded image, if the caller already holds it.
+    - upload_id (str): Upload whose bytes are looked up in the local blob cache before image_url is fetched.
     - n_clusters (int): Number of clusters for KMeans.
     - blur_radius (float): Radius for Gaussian blur.
     - line_size (int): Size of the edges to be detected.
@@ -37,52 +60,133 @@ def process_image(
     - font_scale_medium (float): Font scale for medium-sized images.
     - font_scale_large (float): Font scale for large images.
     - thickness (int): Thickness of the text.
-    - min_size (int): Minimum size in pixels for a facet to be retained.
+    - min_size (int): Minimum size in pixels for a facet to be retained. The input image must also be at least
+      min_size pixels wide and high, regardless of output_max_edge.
     - denoise_weight (float): Weight for denoising.
+    - denoise_backend (str): Denoising filter: "tv_bregman", "bilateral" or "nl_means".
+    - fit_method (str): Palette fitting method: "exact" (KMeans on every pixel), "sample" (KMeans on a stratified pixel sample) or "minibatch" (MiniBatchKMeans in float32).
+    - sample_size (int): Approximate number of pixels used to fit the palette when fit_method is "sample".
+    - use_cache (bool): Reuse a cached result for the same image bytes and parameters, and cache new results.
+      Intermediate stages are cached as well, so changing a late-stage parameter only re-runs the stages downstream of it.
+    - max_working_edge (int): If set, denoising, clustering and facet cleanup run on a copy downscaled so its longest edge is at most this many pixels.
+      min_size is rescaled to the working resolution automatically.
+    - output_max_edge (int): If set, the cluster and outline images are rendered with their longest edge capped at this many pixels.
+      area_threshold_factor is rescaled to the output resolution automatically.
+    - n_clusters_list (list): If set, n_clusters is ignored and one variant is produced per cluster count.
+      The image is decoded and preprocessed once, and each k-means is warm-started from the palette of the next smaller count.
+    - image_format (str): Encoding of both images: "png" (indexed PNG) or "webp" (lossless WebP).
+    - outline_format (str): "raster" for an outline image encoded as image_format, or "svg" for a vector outline
+      with boundaries as paths and labels as text.
+    - on_cluster (callable): Called as on_cluster(n_clusters, cluster_image_bytes) as soon as a cluster image is ready,
+      before its outline is drawn. Not called for variants served from the result cache.
     """
 
-    # Create the clustered image
-    if image_url:
-        creator = ClusteredImageCreator(
-            file_name=file_name,
-            entry_id=entry_id,
-            image_url=image_url,
-            n_clusters=n_clusters,
-            blur_radius=blur_radius,
-            denoise_weight=denoise_weight,
-            min_size=min_size
-        )
-    elif file_name:
+    with stage("read_input"):
+        if image_bytes is None and upload_id:
+            image_bytes = blob_cache.get(upload_id)
+
+        if image_bytes is None:
+            if image_url:
+                image_bytes = ImageProcessor.read_image_bytes(image_url=image_url)
+            elif file_name:
+                image_bytes = ImageProcessor.read_image_bytes(image_path=f"input/{file_name}.jpg")
+            else:
+                raise ValueError("Either file_name or image_url must be provided.")
+
+    params = {
+        "n_clusters": n_clusters,
+        "blur_radius": blur_radius,
+        "line_size": line_size,
+        "blur_value": blur_value,
+        "filter_size": filter_size,
+        "area_threshold_factor": area_threshold_factor,
+        "outline_color": list(outline_color),
+        "font_scale_small": font_scale_small,
+        "font_scale_medium": font_scale_medium,
+        "font_scale_large": font_scale_large,
+        "thickness": thickness,
+        "min_size": min_size,
+        "denoise_weight": denoise_weight,
+        "denoise_backend": denoise_backend,
+        "fit_method": fit_method,
+        "sample_size": sample_size,
+        "max_working_edge": max_working_edge,
+        "output_max_edge": output_max_edge,
+        "image_format": image_format,
+        "outline_format": outline_format
+    }
+
+    # Variants are computed in increasing order so each warm-starts from the
+    # previous one; a variant's result depends on the counts before it.
+    sweep = sorted(set(n_clusters_list)) if n_clusters_list else [n_clusters]
+    cache_keys = {}
+    for i, n in enumerate(sweep):
+        variant_params = {**params, "n_clusters": n}
+        if i > 0:
+            variant_params["warm_start"] = sweep[:i]
+        cache_keys[n] = ResultCache.make_key(image_bytes, variant_params)
+
+    results = {}
+    if use_cache:
+        for n in sweep:
+            cached = result_cache.get(cache_keys[n])
+            if cached is None:
+                break
+            results[n] = cached
+
+    if len(results) < len(sweep):
+        image_key = hashlib.sha256(image_bytes).hexdigest()
+
         creator = ClusteredImageCreator(
-            image_path=f"input/{file_name}.jpg",
-            n_clusters=n_clusters,
+            image_bytes=image_bytes,
+            n_clusters=sweep[0],
             blur_radius=blur_radius,
             denoise_weight=denoise_weight,
-            min_size=min_size
+            denoise_backend=denoise_backend,
+            min_size=min_size,
+            fit_method=fit_method,
+            sample_size=sample_size,
+            stage_cache=stage_cache if use_cache else None,
+            image_key=image_key,
+            max_working_edge=max_working_edge,
+            output_max_edge=output_max_edge,
+            warm_start=True,
+            image_format=image_format
         )
-    else:
-        raise ValueError("Either file_name or image_url must be provided.")
-    
-    clustered_image, img_cluster_url = creator.create_cluster()
-    
 
-    # Create the outline image
-    outline_creator = OutlineCreator(
-        file_name=file_name,
-        entry_id=entry_id,
-        image=clustered_image,
-        line_size=line_size,
-        blur_value=blur_value,
-        filter_size=filter_size,
-        area_threshold_factor=area_threshold_factor,
-        outline_color=outline_color,
-        font_scale_small=font_scale_small,
-        font_scale_medium=font_scale_medium,
-        font_scale_large=font_scale_large,
-        thickness=thickness,
-        min_size=min_size,
-        file_options=file_options
-    )
-    outline_image, img_outline_url, label_color_mapping = outline_creator.create_outline()
+        for n in sweep:
+            # Create the clustered image
+            creator.n_clusters = n
+            region_graph, palette, cluster_image_bytes = creator.create_cluster()
+            if on_cluster is not None:
+                on_cluster(n, cluster_image_bytes)
+
+            # Create the outline image
+            outline_creator = OutlineCreator(
+                region_graph=region_graph,
+                palette=palette,
+                line_size=line_size,
+                blur_value=blur_value,
+                filter_size=filter_size,
+                # Region areas scale with the square of the output scale, while the area
+                # threshold is derived from the longest edge, which scales linearly.
+                area_threshold_factor=area_threshold_factor / creator.output_scale,
+                outline_color=outline_color,
+                font_scale_small=font_scale_small,
+                font_scale_medium=font_scale_medium,
+                font_scale_large=font_scale_large,
+                thickness=thickness,
+                stage_cache=stage_cache if use_cache else None,
+                region_graph_key=creator.region_graph_key,
+                image_format=image_format,
+                outline_format=outline_format
+            )
+            outline_image, outline_image_bytes, label_color_mapping = outline_creator.create_outline()
+            results[n] = (cluster_image_bytes, outline_image_bytes, label_color_mapping)
+
+            if use_cache:
+                result_cache.put(cache_keys[n], cluster_image_bytes, outline_image_bytes, label_color_mapping)
 
-    return img_cluster_url, img_outline_url, label_color_mapping
+    if n_clusters_list:
+        return [results[n] for n in n_clusters_list]
+    return results[n_clusters]
@@ -0,0 +1,141 @@
+import numpy as np
+import cv2
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from skimage.measure import label
+
+class RegionGraph:
+    """
+    Connected regions of a label map with per-region statistics and adjacency.
+
+    The label map is labelled once (4-connectivity, no background). Region 0
+    is an empty sentinel; regions 1..n are numbered in raster order of their
+    first pixel. Later stages merge regions by remapping region ids, so no
+    further labelling pass over the image is needed.
+
+    Per-region arrays, indexed by region id:
+    - values: palette index of the region.
+    - areas: pixel count.
+    Adjacency is stored as edge arrays adj_src, adj_dst (both directions) and
+    adj_counts, the length of the shared boundary in pixel pairs.
+    """
+    def __init__(self, label_map):
+        raster = label(label_map, background=-1, connectivity=1).astype(np.int32)
+        values = np.zeros(raster.max() + 1, dtype=label_map.dtype)
+        values[raster.ravel()] = label_map.ravel()
+        self.set_raster(raster, values)
+
+    def set_raster(self, raster, values):
+        num_regions = len(values)
+        flat = raster.ravel()
+
+        self.raster = raster
+        self.lookup = np.arange(num_regions, dtype=np.int32)
+        self.values = values
+        self.areas = np.bincount(flat, minlength=num_regions)
+
+        src = np.concatenate([raster[:, :-1].ravel(), raster[:-1, :].ravel()])
+        dst = np.concatenate([raster[:, 1:].ravel(), raster[1:, :].ravel()])
+        differs = src != dst
+        self.set_adjacency(src[differs], dst[differs], np.ones(np.count_nonzero(differs), dtype=np.int64))
+
+    def set_adjacency(self, src, dst, counts):
+        num_regions = len(self.values)
+        src, dst = np.concatenate([src, dst]), np.concatenate([dst, src])
+        counts = np.concatenate([counts, counts])
+        keys, inverse = np.unique(src.astype(np.int64) * num_regions + dst, return_inverse=True)
+        self.adj_src = keys // num_regions
+        self.adj_dst = keys % num_regions
+        self.adj_counts = np.bincount(inverse, weights=counts).astype(np.int64)
+
+    @property
+    def num_regions(self):
+        return len(self.values)
+
+    def region_map(self):
+        return self.lookup[self.raster]
+
+    def value_map(self):
+        return self.values[self.lookup][self.raster]
+
+    def merge_targets(self, is_kept):
+        """
+        Pick the region every dropped region is merged into.
+
+        Dropped regions are resolved in bulk passes: each joins the resolved
+        neighbour it shares the longest boundary with, and a region resolved
+        in one pass can absorb its own dropped neighbours in the next.
+        Returns the target of every region (itself if kept or unresolved) and
+        a mask of regions that ended up in a kept region.
+        """
+        num_regions = self.num_regions
+        target = np.arange(num_regions)
+        resolved = is_kept.copy()
+        src, dst, counts = self.adj_src, self.adj_dst, self.adj_counts
+
+        while True:
+            edges = ~resolved[src] & resolved[dst]
+            if not edges.any():
+                break
+
+            # Sum boundary lengths per (dropped region, kept region it resolves to)
+            merge_keys, inverse = np.unique(src[edges] * num_regions + target[dst[edges]], return_inverse=True)
+            merge_counts = np.bincount(inverse, weights=counts[edges])
+            merge_src, merge_dst = merge_keys // num_regions, merge_keys % num_regions
+
+            # Keep the neighbour with the longest shared boundary for each dropped region
+            order = np.lexsort((merge_counts, merge_src))
+            merge_src, merge_dst = merge_src[order], merge_dst[order]
+            best = np.append(merge_src[1:] != merge_src[:-1], True)
+            target[merge_src[best]] = merge_dst[best]
+            resolved[merge_src[best]] = True
+
+        return target, resolved
+
+    def merge(self, target):
+        """
+        Merge every region into target[region] and return the old-to-new id map.
+
+        Merged regions take their target's value, and touching regions that end
+        up with the same value are joined as well, so regions stay maximal
+        connected components. New ids keep the raster order of first pixels.
+        """
+        num_regions = self.num_regions
+        values = self.values[target]
+
+        same_value = values[self.adj_src] == values[self.adj_dst]
+        rows = np.concatenate([np.arange(num_regions), self.adj_src[same_value]])
+        cols = np.concatenate([target, self.adj_dst[same_value]])
+        graph = coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(num_regions, num_regions))
+        num_components, components = connected_components(graph, directed=False)
+
+        # Number components by their lowest region id; the empty region 0 stays 0.
+        first_region = np.full(num_components, num_regions)
+        np.minimum.at(first_region, components, np.arange(num_regions))
+        rank = np.empty(num_components, dtype=np.int32)
+        rank[np.argsort(first_region)] = np.arange(num_components)
+        new_ids = rank[components]
+
+        new_values = np.zeros(num_components, dtype=self.values.dtype)
+        new_values[new_ids] = values
+        self.areas = np.bincount(new_ids, weights=self.areas, minlength=num_components).astype(np.int64)
+
+        src, dst = new_ids[self.adj_src], new_ids[self.adj_dst]
+        keep = src < dst
+        self.values = new_values
+        self.set_adjacency(src[keep], dst[keep], self.adj_counts[keep])
+        self.lookup = new_ids[self.lookup]
+
+        return new_ids
+
+    def resized(self, size):
+        """
+        Return a graph for the region map resized to size (width, height) with
+        nearest-neighbour sampling. Region ids and values are kept.
+        """
+        region_map = self.region_map()
+        if region_map.shape[::-1] == tuple(size):
+            return self
+        resized = RegionGraph.__new__(RegionGraph)
+        resized.set_raster(cv2.resize(region_map, tuple(size), interpolation=cv2.INTER_NEAREST), self.values.copy())
+        return resized
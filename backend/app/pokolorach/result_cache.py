@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import uuid
+from .disk_lru import cache_entries, evict_lru
+
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "pokolorach_cache"))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+class ResultCache:
+    """
+    Size-bounded on-disk LRU cache of process_image results.
+
+    Entries are keyed by a hash of the input image bytes and the processing
+    parameters. Each entry is a directory holding the cluster PNG, the outline
+    PNG and the label colour mapping; its mtime is the last access time.
+    """
+    CLUSTER_FILE = "cluster.png"
+    OUTLINE_FILE = "outline.png"
+    MAPPING_FILE = "mapping.json"
+
+    def __init__(self, cache_dir=RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(image_bytes, params):
+        digest = hashlib.sha256(image_bytes)
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        entry_dir = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(entry_dir, self.CLUSTER_FILE), "rb") as f:
+                cluster_image_bytes = f.read()
+            with open(os.path.join(entry_dir, self.OUTLINE_FILE), "rb") as f:
+                outline_image_bytes = f.read()
+            with open(os.path.join(entry_dir, self.MAPPING_FILE)) as f:
+                label_color_mapping = {int(k): tuple(v) for k, v in json.load(f).items()}
+            os.utime(entry_dir)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return cluster_image_bytes, outline_image_bytes, label_color_mapping
+
+    def put(self, key, cluster_image_bytes, outline_image_bytes, label_color_mapping):
+        entry_dir = os.path.join(self.cache_dir, key)
+        # Write into a private directory and rename it into place, so that
+        # concurrent workers never see a half-written entry.
+        tmp_dir = os.path.join(self.cache_dir, f".tmp-{uuid.uuid4()}")
+        os.makedirs(tmp_dir)
+        with open(os.path.join(tmp_dir, self.CLUSTER_FILE), "wb") as f:
+            f.write(cluster_image_bytes)
+        with open(os.path.join(tmp_dir, self.OUTLINE_FILE), "wb") as f:
+            f.write(outline_image_bytes)
+        with open(os.path.join(tmp_dir, self.MAPPING_FILE), "w") as f:
+            json.dump({str(k): [int(c) for c in v] for k, v in label_color_mapping.items()}, f)
+
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another worker stored the same result first.
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self):
+        evict_lru(self.cache_dir, self.max_bytes)
+
+    def stats(self):
+        entries = cache_entries(self.cache_dir)
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries)
+        }
+
+result_cache = ResultCache()
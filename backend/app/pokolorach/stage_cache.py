@@ -0,0 +1,65 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import uuid
+from .instrumentation import stage as instrument_stage
+from .disk_lru import evict_lru
+
+STAGE_CACHE_DIR = os.getenv("STAGE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "pokolorach_stages"))
+STAGE_CACHE_MAX_BYTES = int(os.getenv("STAGE_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024))
+
+class StageCache:
+    """
+    Size-bounded on-disk LRU cache of intermediate pipeline artefacts.
+
+    A stage's key is derived from its name, its own parameters and the key of
+    the stage it consumes, so changing a parameter only invalidates that stage
+    and the ones downstream of it.
+    """
+    def __init__(self, cache_dir=STAGE_CACHE_DIR, max_bytes=STAGE_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(stage, parent_key, params):
+        payload = json.dumps([stage, parent_key, params], sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get_or_compute(self, stage, parent_key, params, compute):
+        key = self.make_key(stage, parent_key, params)
+        path = os.path.join(self.cache_dir, f"{key}.pkl")
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+            os.utime(path)
+            self.hits += 1
+            return key, value
+        except FileNotFoundError:
+            self.misses += 1
+
+        value = compute()
+
+        tmp_path = os.path.join(self.cache_dir, f".tmp-{uuid.uuid4()}")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self.evict()
+
+        return key, value
+
+    def evict(self):
+        evict_lru(self.cache_dir, self.max_bytes)
+
+
+def run_stage(stage_cache, stage, parent_key, params, compute):
+    with instrument_stage(stage):
+        if stage_cache is None:
+            return StageCache.make_key(stage, parent_key, params), compute()
+        return stage_cache.get_or_compute(stage, parent_key, params, compute)
+
+stage_cache = StageCache()
@@ -0,0 +1,133 @@
+import numpy as np
+import cv2
+
+class SvgOutline:
+    """
+    Vector outline of a label matrix.
+
+    Region boundaries are traced along the cracks between pixels, so every
+    boundary is emitted once and neighbouring regions share it exactly. The
+    crack network is split into chains at junctions, each chain is simplified
+    with Douglas-Peucker (cv2.approxPolyDP) and written as one relative path.
+    Labels become text elements, so the result is resolution independent.
+    """
+    # Cap height of the SVG font relative to its font-size, used to match the
+    # size of the Hershey labels in the raster outline.
+    CAP_HEIGHT = 0.72
+
+    def __init__(self, outline_color=(162, 162, 162), stroke_width=1, epsilon=0.75,
+                 font_family="Helvetica, Arial, sans-serif"):
+        self.outline_color = outline_color
+        self.stroke_width = stroke_width
+        self.epsilon = epsilon
+        self.font_family = font_family
+
+    @staticmethod
+    def crack_edges(mat):
+        # Lattice vertex (x, y) is the top-left corner of pixel (y, x), with id y * (width + 1) + x
+        height, width = mat.shape
+        stride = width + 1
+
+        # Horizontal cracks between vertically adjacent pixels that differ
+        ys, xs = np.nonzero(mat[1:, :] != mat[:-1, :])
+        horizontal_start = (ys + 1) * stride + xs
+        # Vertical cracks between horizontally adjacent pixels that differ
+        ys, xs = np.nonzero(mat[:, 1:] != mat[:, :-1])
+        vertical_start = ys * stride + xs + 1
+
+        starts = np.concatenate([horizontal_start, vertical_start])
+        ends = np.concatenate([horizontal_start + 1, vertical_start + stride])
+        return starts, ends
+
+    def trace(self, mat):
+        """
+        Return the boundary chains of mat as (points, closed) pairs, where points
+        is an (n, 2) array of lattice (x, y) coordinates.
+        """
+        height, width = mat.shape
+        stride = width + 1
+        starts, ends = self.crack_edges(mat)
+        num_edges = len(starts)
+        if num_edges == 0:
+            return []
+
+        endpoints = np.concatenate([starts, ends])
+        degree = np.bincount(endpoints, minlength=(height + 1) * stride)
+        order = np.argsort(endpoints, kind="stable")
+        incident = (order % num_edges).tolist()
+        offsets = np.concatenate([[0], np.cumsum(degree)]).tolist()
+        degree_list = degree.tolist()
+        starts_list, ends_list = starts.tolist(), ends.tolist()
+        used = bytearray(num_edges)
+
+        def walk(vertex, edge):
+            points = [vertex]
+            while True:
+                used[edge] = 1
+                vertex = ends_list[edge] if starts_list[edge] == vertex else starts_list[edge]
+                points.append(vertex)
+                if degree_list[vertex] != 2:
+                    return points
+                first = incident[offsets[vertex]]
+                edge = incident[offsets[vertex] + 1] if first == edge else first
+                if used[edge]:
+                    return points
+
+        chains = []
+        # Open chains run between junctions (or image borders)
+        for vertex in np.flatnonzero((degree > 0) & (degree != 2)).tolist():
+            for edge in incident[offsets[vertex]:offsets[vertex + 1]]:
+                if not used[edge]:
+                    chains.append(walk(vertex, edge))
+        # Whatever is left are closed loops, such as islands inside a region
+        for edge in range(num_edges):
+            if not used[edge]:
+                chains.append(walk(starts_list[edge], edge))
+
+        traced = []
+        for chain in chains:
+            chain = np.array(chain)
+            points = np.stack([chain % stride, chain // stride], axis=1)
+            closed = len(chain) > 2 and chain[0] == chain[-1]
+            traced.append((points[:-1] if closed else points, closed))
+        return traced
+
+    def path_data(self, points, closed):
+        simplified = cv2.approxPolyDP(points.reshape(-1, 1, 2).astype(np.int32), self.epsilon, closed).reshape(-1, 2)
+        steps = np.diff(simplified, axis=0)
+        data = f"M{simplified[0, 0]} {simplified[0, 1]}"
+        if len(steps):
+            data += "l" + " ".join(f"{dx} {dy}" for dx, dy in steps.tolist())
+        return data + ("z" if closed else "")
+
+    def to_svg(self, mat, label_locs, label_font_scales):
+        """
+        Build the SVG document.
+
+        Parameters:
+        - mat (ndarray): Label matrix; boundaries are drawn where neighbouring values differ.
+        - label_locs (list): Label positions as returned by ImageOutline.getLabelLocs.
+        - label_font_scales (list): OpenCV Hershey font scale of each label, as used for the raster outline.
+        """
+        height, width = mat.shape
+        stroke = "#{:02x}{:02x}{:02x}".format(*(int(c) for c in self.outline_color))
+        path = "".join(self.path_data(points, closed) for points, closed in self.trace(mat))
+
+        texts = []
+        for label_info, font_scale in zip(label_locs, label_font_scales):
+            if label_info is None:
+                continue
+            text = str(label_info['value'])
+            (_, text_height), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, font_scale, 1)
+            font_size = text_height / self.CAP_HEIGHT
+            texts.append(f'<text x="{label_info["x"]}" y="{label_info["y"]}" font-size="{font_size:.1f}">{text}</text>')
+
+        return (
+            f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {width} {height}" width="{width}" height="{height}">'
+            f'<rect width="100%" height="100%" fill="#fff"/>'
+            f'<path d="{path}" fill="none" stroke="{stroke}" stroke-width="{self.stroke_width}" '
+            f'stroke-linejoin="round" vector-effect="non-scaling-stroke"/>'
+            f'<g font-family="{self.font_family}" text-anchor="middle" dominant-baseline="central">'
+            + "".join(texts) +
+            '</g></svg>'
+        ).encode()
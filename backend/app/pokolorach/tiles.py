@@ -0,0 +1,74 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Threads per process. Process pools running the pipeline (jobs.py, bulk.py)
+# pass init_process_worker as initializer so that their processes share the
+# CPUs instead of each starting cpu_count threads.
+TILE_WORKERS = int(os.getenv("TILE_WORKERS", os.cpu_count() or 1))
+TILE_MIN_ROWS = int(os.getenv("TILE_MIN_ROWS", 256))
+
+executor = None
+
+
+def get_executor():
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=TILE_WORKERS)
+    return executor
+
+
+def init_process_worker(process_workers):
+    """
+    Initializer for process pools that run the pipeline. Unless TILE_WORKERS
+    is set explicitly, each of the process_workers processes gets an equal
+    share of the CPUs for its tile threads.
+
+    Parameters:
+    - process_workers: number of processes in the pool
+    """
+    global TILE_WORKERS, executor
+    if "TILE_WORKERS" not in os.environ:
+        TILE_WORKERS = max(1, (os.cpu_count() or 1) // process_workers)
+    # A thread pool inherited through fork has no threads behind it
+    executor = None
+
+
+def row_bands(height, workers, min_rows=TILE_MIN_ROWS, max_rows=None):
+    """
+    Split height rows into at most workers bands of at least min_rows rows
+    each. If max_rows is set, bands are also split until none is taller than
+    max_rows, even if that makes more bands than workers. Returns a list of
+    (start, stop) pairs.
+    """
+    num_bands = max(1, min(workers, height // max(1, min_rows)))
+    if max_rows:
+        num_bands = max(num_bands, -(-height // max_rows))
+    bounds = np.linspace(0, height, num_bands + 1).round().astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def map_row_bands(func, array, halo=0, workers=None, min_rows=TILE_MIN_ROWS, max_rows=None):
+    """
+    Apply func to horizontal bands of array on the shared thread pool and
+    stitch the results back together along the first axis.
+
+    Each band is extended by halo rows on both sides (clipped at the image
+    border) so that neighbourhood filters see the same context as on the full
+    image; the halo rows are cropped from the result. func must map an array
+    of n rows to an array of n rows. It only pays off for work that releases
+    the GIL, such as OpenCV calls and most NumPy ufuncs. max_rows bounds the
+    band height, and with it the size of func's temporaries; only as many
+    bands as there are workers are processed at a time.
+    """
+    height = array.shape[0]
+    bands = row_bands(height, workers or TILE_WORKERS, min_rows, max_rows)
+    if len(bands) == 1:
+        return func(array)
+
+    def run(band):
+        start, stop = band
+        top, bottom = max(0, start - halo), min(height, stop + halo)
+        return func(array[top:bottom])[start - top:stop - top]
+
+    return np.concatenate(list(get_executor().map(run, bands)), axis=0)
@@ -0,0 +1,17 @@
+import os
+
+UPLOAD_TTL = int(os.getenv("UPLOAD_TTL", 3600))
+
+
+def upload_key(upload_id: str):
+    return f"upload:{upload_id}"
+
+
+async def save_upload_state(redis, upload_id: str, state: dict):
+    key = upload_key(upload_id)
+    async with redis.pipeline(transaction=True) as pipe:
+        await pipe.hset(key, mapping=state).expire(key, UPLOAD_TTL).execute()
+
+
+async def get_upload_state(redis, upload_id: str):
+    return await redis.hgetall(upload_key(upload_id))
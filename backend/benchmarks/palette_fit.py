@@ -0,0 +1,60 @@
+"""
+Compare palette fitting methods of ColorClusterer on speed and quality.
+
+Quality is the mean CIE76 colour difference (Delta E) between every pixel
+and the palette centre it is assigned to.
+
+Usage (from the backend directory):
+    python -m benchmarks.palette_fit [image_path] [--n-clusters 20] [--sample-size 100000]
+"""
+import argparse
+import time
+
+import numpy as np
+from PIL import Image
+
+from app.pokolorach.image_cluster import ColorClusterer
+
+
+def synthetic_image(height=3000, width=4000, seed=0):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    image = np.stack([
+        0.5 + 0.5 * np.sin(x / 300 + rng.random() * 6),
+        0.5 + 0.5 * np.cos(y / 200 + rng.random() * 6),
+        0.5 + 0.5 * np.sin((x + y) / 500 + rng.random() * 6),
+    ], axis=-1)
+    image += rng.normal(0, 0.03, image.shape).astype(np.float32)
+    return (np.clip(image, 0, 1) * 255).astype(np.uint8)
+
+
+def mean_delta_e(color_clusterer):
+    data = color_clusterer.lab_array.reshape(-1, 3)
+    return float(np.linalg.norm(data - color_clusterer.centers[color_clusterer.labels], axis=1).mean())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("image_path", nargs="?", help="Image to cluster. A 12 MP synthetic image is used if omitted.")
+    parser.add_argument("--n-clusters", type=int, default=20)
+    parser.add_argument("--sample-size", type=int, default=100000)
+    parser.add_argument("--methods", nargs="+", default=["exact", "sample", "minibatch"])
+    args = parser.parse_args()
+
+    if args.image_path:
+        image_array = np.array(Image.open(args.image_path).convert("RGB"))
+    else:
+        image_array = synthetic_image()
+
+    color_clusterer = ColorClusterer(image_array)
+    print(f"Image: {image_array.shape[1]}x{image_array.shape[0]}, n_clusters={args.n_clusters}")
+    print(f"{'method':<10} {'seconds':>9} {'mean dE':>9}")
+    for method in args.methods:
+        start = time.perf_counter()
+        color_clusterer.cluster_image(args.n_clusters, method, args.sample_size)
+        elapsed = time.perf_counter() - start
+        print(f"{method:<10} {elapsed:>9.2f} {mean_delta_e(color_clusterer):>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
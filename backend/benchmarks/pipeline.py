@@ -0,0 +1,299 @@
+"""
+Time and memory-profile every stage of process_image and check its output
+against stored baselines.
+
+Each scene is rendered at 0.5, 2, 12 and 24 MP and run through process_image
+with the caches disabled. Two synthetic scenes are always used: "gradient"
+(smooth colour waves with noise, like a photo) and "shapes" (flat polygons,
+like an illustration); image files given with --images are resized to the
+same sizes. process_image does no storage I/O, so nothing is uploaded.
+
+Before anything is measured, one untimed run pays for lazy imports and
+first-call setup. Every image is then timed --repeat times, keeping the
+fastest run per stage, and traced once more with tracemalloc for peak memory,
+since tracemalloc slows the stages down. Per stage (decode,
+denoise, preprocess, lab_conversion, kmeans, closing, cluster, facets,
+encode_cluster, label_locs, annotate, outline, encode_outline) the
+wall time, CPU time and peak allocated bytes are reported.
+
+With --save the results become the baseline. Otherwise they are compared with
+it and the command exits with status 1 when
+- the cluster image, outline image or label colour mapping differs from the
+  baseline (compared by a hash of the decoded pixels), or
+- a stage takes more CPU time or peaks higher than the baseline by more than
+  the tolerance. CPU time is compared rather than wall time, as it is less
+  affected by other load on the machine. Timings are only compared on a
+  machine with the same CPU count as the one that saved the baseline.
+With --golden-dir the baseline outputs are also stored as images there, and a
+mismatch reports the share of pixels that differ from them.
+
+Usage (from the backend directory):
+    python -m benchmarks.pipeline [--sizes 0.5 2 12 24] [--images photo.jpg] [--save] [--golden-dir DIR]
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import sys
+import time
+from io import BytesIO
+
+import cv2
+import numpy as np
+import sklearn
+from PIL import Image
+
+from app.pokolorach import tiles
+from app.pokolorach.image_cluster import ImageProcessor
+from app.pokolorach.instrumentation import Trace
+from app.pokolorach.process_image import process_image
+from benchmarks.palette_fit import synthetic_image
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baselines", "pipeline.json")
+
+# Megapixels to (height, width), 3:4 like most phone photos
+SIZES = {
+    "0.5": (612, 816),
+    "2": (1224, 1632),
+    "12": (3000, 4000),
+    "24": (4242, 5656),
+}
+
+PARAMS = {
+    "n_clusters": 20,
+    "blur_radius": 1,
+    "use_cache": False,
+}
+
+
+def synthetic_shapes(height, width, seed=0, n_shapes=60):
+    # Shapes are placed in relative coordinates, so every size shows the same scene
+    rng = np.random.default_rng(seed)
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[:] = rng.integers(0, 256, 3)
+    for _ in range(n_shapes):
+        center = rng.random(2)
+        radius = rng.uniform(0.03, 0.2)
+        angles = np.sort(rng.uniform(0, 2 * np.pi, rng.integers(3, 8)))
+        points = center + radius * np.stack([np.cos(angles), np.sin(angles)], axis=1)
+        points = np.round(points * (width, height)).astype(np.int32)
+        cv2.fillPoly(image, [points], rng.integers(0, 256, 3).tolist())
+    noise = rng.normal(0, 4, image.shape)
+    return np.clip(image + noise, 0, 255).astype(np.uint8)
+
+
+def resized(image_array, size):
+    height, width = size
+    # Keep the aspect ratio of the source and match the pixel count of size
+    scale = np.sqrt(height * width / (image_array.shape[0] * image_array.shape[1]))
+    target = (max(1, round(image_array.shape[1] * scale)), max(1, round(image_array.shape[0] * scale)))
+    return np.array(Image.fromarray(image_array).resize(target, Image.LANCZOS))
+
+
+def scenes(image_paths, size):
+    yield "gradient", synthetic_image(*size)
+    yield "shapes", synthetic_shapes(*size)
+    for path in image_paths:
+        image_array = np.array(Image.open(path).convert("RGB"))
+        yield os.path.splitext(os.path.basename(path))[0], resized(image_array, size)
+
+
+def output_hashes(cluster_image_bytes, outline_image_bytes, label_color_mapping):
+    def pixels_hash(image_bytes):
+        image_array = np.array(Image.open(BytesIO(image_bytes)).convert("RGB"))
+        return hashlib.sha256(repr(image_array.shape).encode() + image_array.tobytes()).hexdigest()
+
+    mapping = {str(k): [int(c) for c in v] for k, v in label_color_mapping.items()}
+    return {
+        "cluster": pixels_hash(cluster_image_bytes),
+        "outline": pixels_hash(outline_image_bytes),
+        "mapping": hashlib.sha256(json.dumps(mapping, sort_keys=True).encode()).hexdigest(),
+    }
+
+
+def summarize(records, key):
+    totals = {}
+    for record in records:
+        value = record[key]
+        if value is None:
+            continue
+        if key == "peak_bytes":
+            totals[record["stage"]] = max(totals.get(record["stage"], 0), value)
+        else:
+            totals[record["stage"]] = totals.get(record["stage"], 0) + value
+    return totals
+
+
+def warm_up():
+    image_bytes = ImageProcessor.convert_to_bytes(synthetic_image(*SIZES["0.5"]))
+    process_image(image_bytes=image_bytes, **PARAMS)
+
+
+def run(image_bytes, repeat):
+    # Keep the fastest of the timing runs per stage; peak memory does not need repeating
+    wall_seconds, cpu_seconds = {}, {}
+    for _ in range(repeat):
+        with Trace(memory=False) as trace:
+            result = process_image(image_bytes=image_bytes, **PARAMS)
+        for stage, seconds in summarize(trace.records, "wall_seconds").items():
+            wall_seconds[stage] = min(wall_seconds.get(stage, seconds), seconds)
+        for stage, seconds in summarize(trace.records, "cpu_seconds").items():
+            cpu_seconds[stage] = min(cpu_seconds.get(stage, seconds), seconds)
+
+    with Trace(memory=True) as trace:
+        process_image(image_bytes=image_bytes, **PARAMS)
+    peak_bytes = summarize(trace.records, "peak_bytes")
+
+    stages = {
+        stage: {"wall_seconds": wall_seconds[stage], "cpu_seconds": cpu_seconds[stage], "peak_bytes": peak_bytes.get(stage)}
+        for stage in wall_seconds
+    }
+    return stages, result
+
+
+def environment():
+    return {
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "tile_workers": tiles.TILE_WORKERS,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "scikit-learn": sklearn.__version__,
+    }
+
+
+def golden_paths(golden_dir, key):
+    return os.path.join(golden_dir, f"{key}_cluster.png"), os.path.join(golden_dir, f"{key}_outline.png")
+
+
+def differing_share(image_bytes, golden_path):
+    if not os.path.exists(golden_path):
+        return None
+    image_array = np.array(Image.open(BytesIO(image_bytes)).convert("RGB"))
+    golden_array = np.array(Image.open(golden_path).convert("RGB"))
+    if image_array.shape != golden_array.shape:
+        return 1.0
+    return float(np.any(image_array != golden_array, axis=-1).mean())
+
+
+def compare(key, result, baseline, args, compare_timings):
+    """
+    Return the list of failures of one image against its baseline entry.
+    """
+    failures = []
+    for output, expected in baseline["outputs"].items():
+        if result["outputs"][output] == expected:
+            continue
+        message = f"{key}: {output} output differs from the baseline"
+        if args.golden_dir and output != "mapping":
+            cluster_path, outline_path = golden_paths(args.golden_dir, key)
+            image_bytes = result["images"][0 if output == "cluster" else 1]
+            share = differing_share(image_bytes, cluster_path if output == "cluster" else outline_path)
+            if share is not None:
+                message += f" ({share:.2%} of pixels)"
+        failures.append(message)
+
+    if not compare_timings:
+        return failures
+    for stage, expected in baseline["stages"].items():
+        measured = result["stages"].get(stage)
+        if measured is None:
+            continue
+        seconds, expected_seconds = measured["cpu_seconds"], expected["cpu_seconds"]
+        if seconds > expected_seconds * (1 + args.tolerance) and seconds - expected_seconds > args.min_seconds:
+            failures.append(f"{key}: {stage} took {seconds:.2f} CPU s, baseline {expected_seconds:.2f} CPU s")
+        peak, expected_peak = measured["peak_bytes"], expected["peak_bytes"]
+        if peak is not None and expected_peak is not None \
+                and peak > expected_peak * (1 + args.memory_tolerance) and peak - expected_peak > args.min_bytes:
+            failures.append(f"{key}: {stage} peaked at {peak / 1e6:.1f} MB, baseline {expected_peak / 1e6:.1f} MB")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", default=list(SIZES), choices=list(SIZES), help="Sizes in megapixels.")
+    parser.add_argument("--images", nargs="*", default=[], help="Sample images to resize to each size.")
+    parser.add_argument("--repeat", type=int, default=3, help="Timing runs per image; the fastest is kept.")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save", action="store_true", help="Store the results as the new baseline.")
+    parser.add_argument("--golden-dir", help="Directory of baseline output images.")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative growth of a stage's CPU time.")
+    parser.add_argument("--min-seconds", type=float, default=0.05, help="Slowdowns below this many seconds are ignored.")
+    parser.add_argument("--memory-tolerance", type=float, default=0.1, help="Allowed relative growth of a stage's peak memory.")
+    parser.add_argument("--min-bytes", type=int, default=2 ** 20, help="Peak memory growth below this many bytes is ignored.")
+    args = parser.parse_args()
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    baseline_images = baselines.get("images", {})
+    compare_timings = baselines.get("environment", {}).get("cpu_count") == os.cpu_count()
+    if baselines and baselines.get("params") != PARAMS and not args.save:
+        sys.exit(f"The baseline was saved with params {baselines.get('params')}, not {PARAMS}; re-run with --save.")
+    if baselines and not compare_timings and not args.save:
+        print(f"The baseline was saved on {baselines['environment']}, this is {environment()}; "
+              f"only outputs are compared.")
+
+    warm_up()
+    results, failures = {}, []
+    for megapixels in args.sizes:
+        for name, image_array in scenes(args.images, SIZES[megapixels]):
+            key = f"{name}_{megapixels}mp"
+            image_bytes = ImageProcessor.convert_to_bytes(image_array)
+            start = time.perf_counter()
+            stages, (cluster_image_bytes, outline_image_bytes, label_color_mapping) = run(image_bytes, args.repeat)
+            result = {
+                "width": image_array.shape[1],
+                "height": image_array.shape[0],
+                "stages": stages,
+                "outputs": output_hashes(cluster_image_bytes, outline_image_bytes, label_color_mapping),
+                "images": (cluster_image_bytes, outline_image_bytes),
+            }
+            results[key] = result
+
+            print(f"\n{key} ({result['width']}x{result['height']}, {time.perf_counter() - start:.1f}s)")
+            print(f"{'stage':<16} {'wall s':>8} {'cpu s':>8} {'peak MB':>9} {'baseline cpu s':>15}")
+            baseline_stages = baseline_images.get(key, {}).get("stages", {})
+            for stage, measured in stages.items():
+                peak = measured["peak_bytes"]
+                baseline_seconds = baseline_stages.get(stage, {}).get("cpu_seconds")
+                print(f"{stage:<16} {measured['wall_seconds']:>8.2f} {measured['cpu_seconds']:>8.2f} "
+                      f"{peak / 1e6 if peak is not None else float('nan'):>9.1f} "
+                      f"{baseline_seconds if baseline_seconds is not None else float('nan'):>15.2f}")
+
+            if not args.save and key in baseline_images:
+                failures.extend(compare(key, result, baseline_images[key], args, compare_timings))
+
+    if args.save:
+        if args.golden_dir:
+            os.makedirs(args.golden_dir, exist_ok=True)
+            for key, result in results.items():
+                for path, image_bytes in zip(golden_paths(args.golden_dir, key), result["images"]):
+                    with open(path, "wb") as f:
+                        f.write(image_bytes)
+        # Images not run this time keep their previous baseline
+        baseline_images.update({
+            key: {k: v for k, v in result.items() if k != "images"} for key, result in results.items()
+        })
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump({"environment": environment(), "params": PARAMS, "images": baseline_images}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"\nSaved the baseline of {len(results)} images to {args.baseline}")
+        return
+
+    missing = [key for key in results if key not in baseline_images]
+    if missing:
+        print(f"\nNo baseline for {', '.join(missing)}; run with --save to add it.")
+    if failures:
+        print("\nRegressions:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+    print("\nNo regressions.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Measure how the tiled per-pixel stages scale with the number of tile workers.
+
+Times the Lab conversion, nearest-centre assignment and boundary mask on one
+image for each worker count. Wall time should drop roughly in proportion to
+the number of workers, up to the number of physical cores.
+
+Usage (from the backend directory):
+    python -m benchmarks.tiles [image_path] [--workers 1 2 4 8] [--n-clusters 20]
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+from app.pokolorach import tiles
+from app.pokolorach.image_cluster import ColorClusterer
+from app.pokolorach.image_outline import ImageOutline
+from benchmarks.palette_fit import synthetic_image
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("image_path", nargs="?", help="Image to process. A 24 MP synthetic image is used if omitted.")
+    parser.add_argument("--workers", type=int, nargs="+", default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    parser.add_argument("--n-clusters", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.image_path:
+        image_array = np.array(Image.open(args.image_path).convert("RGB"))
+    else:
+        image_array = synthetic_image(4000, 6000)
+
+    rng = np.random.default_rng(0)
+    centers = rng.uniform((0, -60, -60), (100, 60, 60), (args.n_clusters, 3))
+    image_outline = ImageOutline(palette=None)
+
+    print(f"Image: {image_array.shape[1]}x{image_array.shape[0]}")
+    print(f"{'workers':>7} {'rgb2lab':>9} {'assign':>9} {'boundary':>9}")
+    for workers in args.workers:
+        tiles.TILE_WORKERS = workers
+        if tiles.executor is not None:
+            tiles.executor.shutdown()
+            tiles.executor = None
+
+        color_clusterer, lab_seconds = timed(lambda: ColorClusterer(image_array))
+        labels, assign_seconds = timed(lambda: ColorClusterer.assign_labels(color_clusterer.lab_array, centers))
+        label_map = labels.reshape(image_array.shape[:2]).astype(np.uint8)
+        _, boundary_seconds = timed(lambda: image_outline.boundary_mask(label_map))
+        print(f"{workers:>7} {lab_seconds:>9.2f} {assign_seconds:>9.2f} {boundary_seconds:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import cv2
+import numpy as np
+import pytest
+
+from app.pokolorach import tiles
+from app.pokolorach.image_cluster import ColorClusterer
+
+
+def reference_closing(centers, labels, shape, kernel_size=(5, 5)):
+    # Closing on the full centre-colour image, as before it was banded
+    clustered_image = centers.astype(np.float32)[labels].reshape(shape + (3,))
+    closed_image = cv2.morphologyEx(clustered_image, cv2.MORPH_CLOSE, np.ones(kernel_size, np.uint8))
+    data = closed_image.reshape(-1, 3)
+    centers = centers.astype(np.float32)
+    distances = np.einsum("ij,ij->i", centers, centers) - 2 * data @ centers.T
+    return np.argmin(distances, axis=1).reshape(shape).astype(np.uint8)
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_banded_closing_matches_full_image(workers):
+    previous_workers, previous_executor = tiles.TILE_WORKERS, tiles.executor
+    tiles.TILE_WORKERS, tiles.executor = workers, None
+    try:
+        rng = np.random.default_rng(0)
+        height, width = 301, 90
+        # Blocks with speckles, so closing changes pixels near band edges
+        labels = np.kron(rng.integers(0, 6, (height // 7 + 1, width // 9 + 1)), np.ones((7, 9), dtype=np.int64))[:height, :width]
+        speckles = rng.random((height, width)) < 0.05
+        labels[speckles] = rng.integers(0, 6, speckles.sum())
+
+        color_clusterer = ColorClusterer.__new__(ColorClusterer)
+        color_clusterer.image_array = np.zeros((height, width, 3), dtype=np.uint8)
+        color_clusterer.centers = rng.uniform((0, -60, -60), (100, 60, 60), (6, 3))
+        color_clusterer.labels = labels.ravel()
+
+        expected = reference_closing(color_clusterer.centers, labels.ravel(), (height, width))
+        label_map = color_clusterer.apply_morphological_closing(band_rows=16)
+        assert label_map.dtype == np.uint8
+        np.testing.assert_array_equal(label_map, expected)
+    finally:
+        if tiles.executor is not None:
+            tiles.executor.shutdown()
+        tiles.TILE_WORKERS, tiles.executor = previous_workers, previous_executor
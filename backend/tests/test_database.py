@@ -0,0 +1,98 @@
+import asyncio
+import threading
+import time
+
+import pytest
+import uvicorn
+from fastapi import FastAPI, Request
+
+from app import database
+
+# A service-role-shaped JWT; the stand-in does not check it
+SECRET_KEY = "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoic2VydmljZV9yb2xlIn0.x"
+
+
+def stand_in_app(requests):
+    """
+    Local stand-in for the Supabase storage and PostgREST endpoints used by
+    database.py. Every request is recorded, and each upload waits until a
+    second upload has arrived, so overlapping uploads can be told apart from
+    sequential ones.
+    """
+    app = FastAPI()
+    uploads_in_flight = {"count": 0, "both_arrived": None}
+
+    @app.middleware("http")
+    async def record(request: Request, call_next):
+        requests.append((request.method, request.url.path, dict(request.query_params)))
+        return await call_next(request)
+
+    @app.post("/storage/v1/object/sign/{bucket}/{path:path}")
+    async def sign(bucket: str, path: str):
+        return {"signedURL": f"/object/sign/{bucket}/{path}?token=t"}
+
+    @app.post("/storage/v1/object/{bucket}/{path:path}")
+    async def upload(bucket: str, path: str, request: Request):
+        await request.body()
+        if uploads_in_flight["both_arrived"] is None:
+            uploads_in_flight["both_arrived"] = asyncio.Event()
+        uploads_in_flight["count"] += 1
+        if uploads_in_flight["count"] == 2:
+            uploads_in_flight["both_arrived"].set()
+        try:
+            await asyncio.wait_for(uploads_in_flight["both_arrived"].wait(), timeout=2)
+            overlapped = True
+        except asyncio.TimeoutError:
+            overlapped = False
+        requests.append(("overlapped", path, overlapped))
+        return {"Key": f"{bucket}/{path}"}
+
+    @app.patch("/rest/v1/{table}")
+    async def update(table: str, request: Request):
+        requests.append(("body", table, await request.json()))
+        return [{"id": 7}]
+
+    return app
+
+
+@pytest.fixture
+def stand_in(monkeypatch):
+    requests = []
+    server = uvicorn.Server(uvicorn.Config(stand_in_app(requests), host="127.0.0.1", port=0, log_level="error"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+
+    monkeypatch.setattr(database, "SUPABASE_URL", f"http://127.0.0.1:{port}")
+    monkeypatch.setattr(database, "SUPABASE_SECRET_KEY", SECRET_KEY)
+    monkeypatch.setattr(database, "supabase", None)
+    yield requests
+    server.should_exit = True
+    thread.join()
+
+
+def test_save_result_images_uploads_concurrently_and_updates_once(stand_in):
+    async def save():
+        # The client is bound to the event loop it was created on
+        database.supabase_lock = asyncio.Lock()
+        return await database.save_result_images(
+            entry_id=7, filename="image.png", cluster_image_bytes=b"cluster", outline_image_bytes=b"outline")
+
+    img_cluster_url, img_outline_url = asyncio.run(save())
+    assert "/cluster_image/cluster_image/image.png" in img_cluster_url
+    assert "/outline_image/outline_image/image.png" in img_outline_url
+
+    uploads = [path for method, path, _ in stand_in if method == "POST" and "/object/sign/" not in path]
+    assert sorted(uploads) == ["/storage/v1/object/cluster_image/cluster_image/image.png",
+                               "/storage/v1/object/outline_image/outline_image/image.png"]
+    assert [overlapped for kind, _, overlapped in stand_in if kind == "overlapped"] == [True, True]
+
+    updates = [(path, query) for method, path, query in stand_in if method == "PATCH"]
+    assert updates == [("/rest/v1/Entries", {"id": "eq.7"})]
+    assert [body for kind, _, body in stand_in if kind == "body"] == [
+        {"img_cluster_url": img_cluster_url, "img_outline_url": img_outline_url}]
+
+    # Nothing is read back after the update
+    assert not [path for method, path, _ in stand_in if method == "GET"]
@@ -0,0 +1,24 @@
+import os
+
+from app.pokolorach.disk_lru import cache_entries, evict_lru
+
+
+def write(path, size, mtime):
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    os.utime(path, (mtime, mtime))
+
+
+def test_evict_lru_removes_oldest_files_and_directories(tmp_path):
+    write(tmp_path / "oldest", 100, 1)
+    os.mkdir(tmp_path / "older")
+    write(tmp_path / "older" / "a", 60, 2)
+    write(tmp_path / "older" / "b", 40, 2)
+    os.utime(tmp_path / "older", (2, 2))
+    write(tmp_path / "newest", 100, 3)
+    write(tmp_path / ".in_progress", 1000, 0)
+
+    assert sorted(size for _, size, _ in cache_entries(tmp_path)) == [100, 100, 100]
+
+    evict_lru(tmp_path, 150)
+    assert sorted(os.listdir(tmp_path)) == [".in_progress", "newest"]
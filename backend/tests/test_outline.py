@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+from app.pokolorach import tiles
+from app.pokolorach.image_outline import ImageOutline
+
+
+def are_neighbors_same(mat, x, y):
+    width = mat.shape[1]
+    height = mat.shape[0]
+    val = mat[y, x]
+    neighbors = [(x + 1, y), (x, y + 1)]
+
+    for xx, yy in neighbors:
+        if 0 <= xx < width and 0 <= yy < height:
+            if mat[yy, xx] != val:
+                return False
+    return True
+
+
+def reference_outline(mat):
+    # The per-pixel loop that ImageOutline.outline replaced, kept as it was
+    height, width = mat.shape
+    line_mat = np.zeros((height, width), dtype=np.uint8)
+    outlined_pixels = set()
+
+    for y in range(height):
+        for x in range(width):
+            if (x, y) in outlined_pixels:
+                continue
+
+            if are_neighbors_same(mat, x, y):
+                if (x + 1 < width and mat[y, x] != mat[y, x + 1]) or \
+                   (y + 1 < height and mat[y, x] != mat[y + 1, x]):
+                    line_mat[y, x] = 162
+                    outlined_pixels.add((x, y))
+                else:
+                    line_mat[y, x] = 255
+            else:
+                line_mat[y, x] = 162
+
+    return line_mat
+
+
+@pytest.fixture
+def tile_workers():
+    previous_workers, previous_executor = tiles.TILE_WORKERS, tiles.executor
+    tiles.TILE_WORKERS, tiles.executor = 4, None
+    yield
+    tiles.executor.shutdown()
+    tiles.TILE_WORKERS, tiles.executor = previous_workers, previous_executor
+
+
+def label_maps():
+    rng = np.random.default_rng(0)
+    stripes = np.zeros((40, 60), dtype=np.uint8)
+    stripes[::2] = 1
+    return {
+        "random": rng.integers(0, 5, (50, 70)).astype(np.uint8),
+        "single_region": np.full((30, 45), 3, dtype=np.uint8),
+        "row_stripes": stripes,
+        "column_stripes": np.ascontiguousarray(stripes.T),
+        "blocks": np.kron(rng.integers(0, 4, (6, 8)), np.ones((7, 9), dtype=np.int64)).astype(np.uint8),
+    }
+
+
+@pytest.mark.parametrize("name", list(label_maps()))
+def test_outline_matches_reference(name):
+    mat = label_maps()[name]
+    image_outline = ImageOutline(palette=None)
+    expected = reference_outline(mat)
+    np.testing.assert_array_equal(image_outline.outline(mat), expected)
+    np.testing.assert_array_equal(image_outline.boundary_mask(mat), expected == 162)
+
+
+def test_outline_matches_reference_across_row_bands(tile_workers):
+    # Tall enough for several bands of TILE_MIN_ROWS rows, with band edges
+    # falling inside regions and on region boundaries
+    height = 4 * tiles.TILE_MIN_ROWS + 37
+    assert len(tiles.row_bands(height, tiles.TILE_WORKERS)) > 1
+    rng = np.random.default_rng(1)
+    mat = np.repeat(rng.integers(0, 3, (height // 3 + 1, 40)), 3, axis=0)[:height].astype(np.uint8)
+    mat[tiles.TILE_MIN_ROWS - 1:tiles.TILE_MIN_ROWS + 1] = rng.integers(0, 3, (2, 40))
+
+    image_outline = ImageOutline(palette=None)
+    expected = reference_outline(mat)
+    np.testing.assert_array_equal(image_outline.outline(mat), expected)
+    np.testing.assert_array_equal(image_outline.boundary_mask(mat), expected == 162)
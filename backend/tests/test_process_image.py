@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from io import BytesIO
+from PIL import Image
+
+from app.pokolorach.image_cluster import ImageProcessor
+from app.pokolorach.process_image import process_image
+
+
+def gradient_image_bytes(height, width):
+    y, x = np.mgrid[0:height, 0:width]
+    image = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1)
+    return ImageProcessor.convert_to_bytes(image.astype(np.uint8))
+
+
+def test_output_max_edge_below_min_size():
+    # The minimum size applies to the input, not to the downscaled output
+    cluster_image_bytes, outline_image_bytes, _ = process_image(
+        image_bytes=gradient_image_bytes(1500, 2000), n_clusters=4, blur_radius=1, min_size=300,
+        max_working_edge=400, output_max_edge=350, use_cache=False)
+
+    assert Image.open(BytesIO(cluster_image_bytes)).size == (350, 262)
+    assert Image.open(BytesIO(outline_image_bytes)).size == (350, 262)
+
+
+def test_input_below_min_size_is_rejected():
+    with pytest.raises(ValueError, match="at least 300x300"):
+        process_image(image_bytes=gradient_image_bytes(200, 400), n_clusters=4, min_size=300, use_cache=False)
@@ -0,0 +1,33 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from app.pokolorach import tiles
+
+
+def tile_workers():
+    return tiles.TILE_WORKERS
+
+
+def test_process_workers_share_the_cpus(monkeypatch):
+    monkeypatch.setattr(tiles, "TILE_WORKERS", tiles.TILE_WORKERS)
+    monkeypatch.setattr(tiles, "executor", tiles.executor)
+    monkeypatch.delenv("TILE_WORKERS", raising=False)
+    monkeypatch.setattr(tiles.os, "cpu_count", lambda: 8)
+    tiles.init_process_worker(4)
+    assert tiles.TILE_WORKERS == 2
+    tiles.init_process_worker(16)
+    assert tiles.TILE_WORKERS == 1
+
+
+def test_explicit_tile_workers_is_kept(monkeypatch):
+    monkeypatch.setenv("TILE_WORKERS", "3")
+    monkeypatch.setattr(tiles, "TILE_WORKERS", 3)
+    monkeypatch.setattr(tiles, "executor", tiles.executor)
+    tiles.init_process_worker(4)
+    assert tiles.TILE_WORKERS == 3
+
+
+def test_pool_initializer_runs_in_the_workers(monkeypatch):
+    monkeypatch.delenv("TILE_WORKERS", raising=False)
+    workers = 2 * (tiles.os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=1, initializer=tiles.init_process_worker, initargs=(workers,)) as pool:
+        assert pool.submit(tile_workers).result() == 1
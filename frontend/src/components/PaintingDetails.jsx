@@ -32,8 +32,34 @@ const PaintingDetails = () => {
   const handleProcess = async () => {
     setProcessing(true);
     try {
-      const response = await axios.post('http://localhost:8000/process');
-      setProcessedImages(response.data);
+      const response = await axios.post('http://localhost:8000/process', null, {
+        params: { upload_id: uniqueFilename, outline_format: 'svg' }
+      });
+      const { job_id } = response.data;
+
+      // The cluster image is shown as soon as it is uploaded, before the outline is done
+      const job = await new Promise((resolve, reject) => {
+        const events = new EventSource(`http://localhost:8000/process/${job_id}/events`);
+        events.addEventListener('cluster_ready', (event) => {
+          const { img_cluster_url } = JSON.parse(event.data);
+          setProcessedImages({ img_cluster_url });
+        });
+        events.addEventListener('uploaded', (event) => {
+          events.close();
+          resolve(JSON.parse(event.data));
+        });
+        events.addEventListener('failed', (event) => {
+          events.close();
+          reject(new Error(JSON.parse(event.data).error));
+        });
+        // Dropped connections are retried by EventSource; it only closes on errors such as an unknown job
+        events.onerror = () => {
+          if (events.readyState === EventSource.CLOSED) {
+            reject(new Error('Lost the progress stream of the job'));
+          }
+        };
+      });
+      setProcessedImages(job);
     } catch (error) {
       console.error('Error processing image:', error);
     } finally {
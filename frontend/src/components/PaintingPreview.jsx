@@ -1,6 +1,11 @@
 import React from 'react';
 
 const PaintingPreview = ({ painting, displayedImage, processing, processedImages, handlePreviewClick }) => {
+  // SVG outlines come inline with the job result, so they render without another request
+  const outlineSrc = processedImages.outline_svg
+    ? `data:image/svg+xml;charset=utf-8,${encodeURIComponent(processedImages.outline_svg)}`
+    : processedImages.img_outline_url;
+
   return (
     <div className="w-full">
       <div className="relative inline-block mb-4 w-full">
@@ -33,12 +38,12 @@ const PaintingPreview = ({ painting, displayedImage, processing, processedImages
             onClick={() => handlePreviewClick(processedImages.img_cluster_url)}
           />
         )}
-        {processedImages.img_outline_url && (
+        {outlineSrc && (
           <img 
-            src={processedImages.img_outline_url} 
+            src={outlineSrc} 
             alt="Outline" 
             className="h-full w-[calc(33%-0.5rem)] sm:w-auto object-cover sm:object-contain rounded-lg cursor-pointer"
-            onClick={() => handlePreviewClick(processedImages.img_outline_url)}
+            onClick={() => handlePreviewClick(outlineSrc)}
           />
         )}
       </div>